@@ -14,10 +14,14 @@ Filtered:
 [2012/03/24: 17:41:14] HIT: 834328, MISS: 45916, TOTAL: 1071825 - 3 stats read
 [2012/03/24: 17:41:15] HIT: 834331, MISS: 45916, TOTAL: 1071830 - 3 stats read
 [2012/03/24: 17:41:16] HIT: 834335, MISS: 45916, TOTAL: 1071835 - 3 stats read
+Rates:
+[2012/03/24: 17:41:18] HIT: 4.0/s, MISS: 0.0/s, TOTAL: 5.0/s - hit ratio 1.0
+[2012/03/24: 17:41:19] HIT: 3.0/s, MISS: 1.0/s, TOTAL: 6.0/s - hit ratio 0.75
 """
 
 import time
 import varnish
+from varnish.stats import StatsSampler
 
 def print_totals(instance):
 
@@ -34,6 +38,16 @@ def print_totals(instance):
     return stats
 
 
+def print_rates(sample):
+    # counters in samples are per second rates
+    print("[{0}] HIT: {1}/s, MISS: {2}/s, TOTAL: {3}/s - hit ratio {4}"\
+            .format(sample.timestamp.strftime('%Y/%m/%d: %H:%M:%S'),
+                    sample.cache_hit,
+                    sample.cache_miss,
+                    sample.client_req,
+                    sample.cache_hit_ratio))
+
+
 if __name__ == '__main__':
 
     try:
@@ -55,5 +69,14 @@ if __name__ == '__main__':
                 print_totals(v)
                 time.sleep(1)
 
+            # the sampler turns successive readings into rates
+            print("Rates:")
+            sampler = StatsSampler()
+            for i in xrange(3):
+                sample = sampler.add(v.stats.read())
+                if sample:
+                    print_rates(sample)
+                time.sleep(1)
+
     except KeyboardInterrupt:
         print("Interrupted")
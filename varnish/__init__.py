@@ -25,10 +25,16 @@ WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import logging
 from .utils import setup_logging
-from . import api
-from .stats import VarnishStats
-from .logs import VarnishLogs
-from .exc import VarnishUninitializedError
+from .exc import VarnishException, VarnishUninitializedError
+try:
+    from . import api
+    from .stats import VarnishStats
+    from .logs import VarnishLogs
+
+except OSError:
+    # libvarnishapi is not available: only capture files can be read, with
+    # varnish.capture
+    api = None
 
 __version__ = (0, 0, 0, 'dev', 0)
 setup_logging()
@@ -56,6 +62,9 @@ class Instance(object):
             self.log_level = self.log_level.lower()
 
     def init(self):
+        if api is None:
+            raise VarnishException('libvarnishapi is not available')
+
         self.vd = api.init()
         if self.log_level:
             log_method = getattr(log, self.log_level)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import collections
+import logging
+import threading
+import time
+from .exc import StreamClosed
+
+try:
+    import trollius as asyncio
+
+except ImportError:
+    asyncio = None
+
+__all__ = ['AsyncStream', 'StreamClosed', 'poll', 'requests']
+log = logging.getLogger(__name__)
+
+
+class _Channel(object):
+    """ Items passed from the producer, running in an executor, to the event
+        loop. The producer only references the channel, so that an
+        AsyncStream nobody uses any more is collected, and closes it.
+    """
+
+    def __init__(self, maxsize, loop):
+        self.maxsize = maxsize
+        self.loop = loop
+        self._items = collections.deque()
+        self._waiter = None
+        self._done = False
+        self._exception = None
+        self._pending = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def run(self, produce):
+        exception = None
+        try:
+            produce(self)
+
+        except Exception as e:
+            log.debug("Producer of %s failed: %s", self, e)
+            exception = e
+
+        try:
+            self.loop.call_soon_threadsafe(self._finish, exception)
+
+        except RuntimeError:
+            # loop already closed
+            pass
+
+    def emit(self, item):
+        """ Queue an item, blocking while the queue is full. Called by the
+            producer, returns False if the stream was closed. """
+        with self._cond:
+            while self._pending >= self.maxsize and not self._closed:
+                self._cond.wait()
+
+            if self._closed:
+                return False
+
+            self._pending += 1
+
+        self.loop.call_soon_threadsafe(self._deliver, item)
+        return True
+
+    def wait(self, timeout):
+        """ Sleep for `timeout` seconds in the producer, returning False if
+            the stream was closed meanwhile """
+        deadline = time.time() + timeout
+        with self._cond:
+            while not self._closed and timeout > 0:
+                self._cond.wait(timeout)
+                timeout = deadline - time.time()
+
+            return not self._closed
+
+    def _taken(self):
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+    def _deliver(self, item):
+        if self._closed:
+            return
+
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            self._waiter = None
+            self._taken()
+            waiter.set_result(item)
+
+        else:
+            self._items.append(item)
+
+    def _finish(self, exception):
+        self._done = True
+        self._exception = exception
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            self._waiter = None
+            waiter.set_exception(self._end())
+
+    def _end(self):
+        if self._closed:
+            return StreamClosed()
+
+        exception, self._exception = self._exception, None
+        return exception or StreamClosed()
+
+    def get(self):
+        future = asyncio.Future(loop=self.loop)
+        if self._items:
+            self._taken()
+            future.set_result(self._items.popleft())
+
+        elif self._done or self._closed:
+            future.set_exception(self._end())
+
+        else:
+            self._waiter = future
+
+        return future
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        self._items.clear()
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            self._waiter = None
+            waiter.set_exception(StreamClosed())
+
+    def __str__(self):
+        return "<%s [queued: %s, done: %s]>" % (self.__class__.__name__,
+                                                len(self._items), self._done)
+
+    def __repr__(self):
+        return str(self)
+
+
+class AsyncStream(object):
+    """ Stream of the items produced by a blocking function run in an
+        executor, so that the event loop is never stalled by
+        libvarnishapi. Requires trollius.
+        `produce` is called with an object whose emit() method must be
+        called for every item, stopping when it returns False; its wait()
+        method sleeps, returning False if the stream was closed.
+        At most `maxsize` items are queued: emit() blocks the producer when
+        the consumer falls behind.
+        get() returns a future resolved with the next item, i.e.
+        `item = yield From(stream.get())`: at the end of the stream it
+        raises StreamClosed, or the exception raised by the producer after
+        the queued items.
+        close() discards the queued items and stops the producer (a
+        producer blocked in libvarnishapi stops when it returns): it is
+        called at the end of a `with` block, and when the stream is garbage
+        collected.
+    """
+
+    def __init__(self, produce, maxsize=100, loop=None, executor=None):
+        if asyncio is None:
+            raise RuntimeError("trollius is not available")
+
+        self.maxsize = maxsize
+        self.loop = loop or asyncio.get_event_loop()
+        self._channel = _Channel(maxsize, self.loop)
+        self.task = self.loop.run_in_executor(executor, self._channel.run,
+                                              produce)
+
+    def get(self):
+        """ Return a future resolved with the next item, see AsyncStream """
+        return self._channel.get()
+
+    def close(self):
+        """ Stop the producer and discard queued items """
+        self._channel.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, '_channel'):
+            self.close()
+
+    def __str__(self):
+        return "<%s [queued: %s, done: %s]>" % (
+                    self.__class__.__name__, len(self._channel._items),
+                    self._channel._done)
+
+    def __repr__(self):
+        return str(self)
+
+
+def poll(varnish_stats, interval=1, maxsize=1, loop=None, executor=None):
+    """ Return an AsyncStream of VarnishStatsArrayReading objects read from
+        a VarnishStats every `interval` seconds. Reads are scheduled on a
+        fixed grid; when the consumer is slower the producer waits, and
+        the readings it missed are skipped.
+    """
+    def produce(stream):
+        view = varnish_stats.view()
+        deadline = time.time()
+        while stream.emit(view.snapshot()):
+            deadline += interval
+            now = time.time()
+            if deadline < now:
+                deadline = now
+
+            if not stream.wait(deadline - now):
+                return
+
+    return AsyncStream(produce, maxsize, loop, executor)
+
+
+def requests(varnish_logs, maxsize=1000, loop=None, executor=None,
+             **kwargs):
+    """ Return an AsyncStream of the RequestLog objects read by
+        VarnishLogs.dispatch_requests(), called with `kwargs` """
+    def produce(stream):
+        varnish_logs.dispatch_requests(stream.emit, **kwargs)
+
+    return AsyncStream(produce, maxsize, loop, executor)
@@ -26,6 +26,8 @@ WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 from .vsm import *
 import stats
 import logs
+import ring
 
 stats = stats
 logs = logs
+ring = ring
@@ -25,12 +25,14 @@ WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 import collections
 import ctypes
 import logging
-from .vsm import _VSM_data
+from .vsm import _VSM_data, _VSM_ReOpen
+from ..vsl import LogTag, LogChunk, VSL_S_CLIENT, VSL_S_BACKEND
 from ..exc import (VarnishException,
                    VarnishUnHandledException)
 
 
 __all__ = ['setup', 'init', 'open_', 'name_to_tag', 'dispatch', 'next',
+           'iterate',
            'process_old_entries', 'process_backend_requests',
            'process_client_requests', 'include_tag', 'include_tag_regex',
            'exclude_tag',  'exclude_tag_regex', 'stop_after', 'skip_first',
@@ -40,9 +42,6 @@ varnishapi = ctypes.CDLL('libvarnishapi.so')
 log = logging.getLogger(__name__)
 
 
-LogTag = collections.namedtuple('LogTag', ['code', 'name'])
-
-
 class LogTags(collections.Mapping):
 
     def __new__(cls):
@@ -99,33 +98,9 @@ class LogTags(collections.Mapping):
         return repr(self._tags_by_name)
 
 
-class LogChunk(object):
-    """ Python object that represent a log entry """
-    tags = None
-
-    def __init__(self, tag, fd, len_, spec, ptr, bitmap):
-        if not self.__class__.tags:
-            self.__class__.tags = LogTags()
-        self.tag = self.tags[tag]
-        self.fd = int(fd)  # file descriptor associated with this record
-        self.client = spec == _VSL_S_CLIENT
-        self.backend = spec == _VSL_S_BACKEND
-        self.data = str(ptr)[0:len_]
-        self.bitmap = int(bitmap)
-
-    def __str__(self):
-        type_ = "client" if self.client else "backend"
-        return "<LogChunk [%s] [%s] [%s]: %s>" % (self.fd, type_,
-                                                  self.tag.name,
-                                                  self.data.strip())
-
-    def __repr__(self):
-        return str(self)
-
-
 # logs
-_VSL_S_CLIENT = (1 << 0)
-_VSL_S_BACKEND = (1 << 1)
+_VSL_S_CLIENT = VSL_S_CLIENT
+_VSL_S_BACKEND = VSL_S_BACKEND
 _VSL_tags_len = 256
 _VSL_tags = (ctypes.c_char_p * _VSL_tags_len).in_dll(varnishapi, 'VSL_tags')
 
@@ -157,7 +132,7 @@ _VSL_Arg.restype = ctypes.c_int
 _VSL_handler_f = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p,
                                   ctypes.c_int, ctypes.c_uint,
                                   ctypes.c_uint, ctypes.c_uint,
-                                  ctypes.c_char_p, ctypes.c_uint64)
+                                  ctypes.c_void_p, ctypes.c_uint64)
 _VSL_Dispatch = varnishapi.VSL_Dispatch
 _VSL_Dispatch.argtypes = [ctypes.POINTER(_VSM_data),
                           _VSL_handler_f, ctypes.py_object]
@@ -169,6 +144,20 @@ _VSL_NextLog.argtypes = [ctypes.POINTER(_VSM_data),
                          ctypes.POINTER(ctypes.c_uint64)]
 _VSL_NextLog.restype = ctypes.c_int
 
+# tags that mark a file descriptor as a client or backend connection, as
+# tracked by VSL_NextLog to compute the spec passed to VSL_Dispatch handlers
+_SLT_CLIENT_START = frozenset(LogTags()[name].code
+                              for name in ('sessionopen', 'reqstart'))
+_SLT_BACKEND_START = frozenset(LogTags()[name].code
+                               for name in ('backendopen', 'backendxid'))
+
+# LogTag objects indexed by tag code, used to build LogChunk objects: the
+# table exported by the library replaces the static one
+_LOG_TAGS = tuple(LogTags()._tags_by_code.get(code)
+                  for code in xrange(_VSL_tags_len))
+LogChunk.tags_by_code = _LOG_TAGS
+LogChunk.tags = LogTags()
+
 
 def setup(varnish_handle):
     """ Setup handle for use with logs functions """
@@ -218,8 +207,9 @@ def dispatch(varnish_handle, callback, private_data=None):
         try:
             lchunk = LogChunk(tag, fd, len_, spec, ptr, bitmap)
 
-        except:
-            return res
+        except KeyError:
+            # tag unknown to libvarnishapi: skip the record
+            return 0
         try:
             res = callback(lchunk, priv)
 
@@ -306,25 +296,120 @@ def ignore_case_in_regex(varnish_handle):
     arg_(varnish_handle, 'C')
 
 
-def next(varnish_handle):
-
-    raise NotImplementedError()
-    # raw_log = ctypes.POINTER(ctypes.c_uint32)()
-    # bitmap = ctypes.c_uint64(0)
-    # result = _VSL_NextLog(varnish_handle,
-    #                       ctypes.byref(raw_log),
-    #                       ctypes.byref(bitmap))
-    # print result
-    # if result != 1:
-    #     return None
-
-    # tag = raw_log[0] >> 24
-    # fd = raw_log[1]
-    # len_ = raw_log[0] & 0xffff
-    # # FIXME
-    # data = ctypes.cast(raw_log, ctypes.c_void_p)
-    # data.value += 2
-    # data = ctypes.cast(data, ctypes.c_char_p)
-
-    # spec = 0  # fixme
-    # return LogChunk(tag, fd, len_, spec, data.value, bitmap.value)
+def _update_specs(specs, tag, fd):
+    """ Keep track of client and backend file descriptors like libvarnishapi
+        does for VSL_Dispatch, and return the spec for the given record
+    """
+    if tag in _SLT_CLIENT_START:
+        specs[fd] = _VSL_S_CLIENT
+
+    elif tag in _SLT_BACKEND_START:
+        specs[fd] = _VSL_S_BACKEND
+
+    return specs.get(fd, 0)
+
+
+def next(varnish_handle, specs=None):
+    """ Read the next log record, without any callback round-trip.
+        `specs` is a dict used to track client and backend file
+        descriptors: pass the same dict on every call to get correct
+        client/backend flags on returned chunks. Flags are only right if no
+        filter hides the records opening connections, see iterate().
+        Records with tags unknown to libvarnishapi are skipped.
+        Returns a LogChunk, None if no record was available before
+        libvarnishapi stopped waiting, False if there are no more records to
+        read (i.e. end of file reached)
+    """
+    raw_log = ctypes.POINTER(ctypes.c_uint32)()
+    bitmap = ctypes.c_uint64(0)
+    if specs is None:
+        specs = {}
+
+    while True:
+        result = _VSL_NextLog(varnish_handle,
+                              ctypes.byref(raw_log),
+                              ctypes.byref(bitmap))
+        if result == 0:
+            return None
+
+        if result != 1:
+            return False
+
+        header = raw_log[0]
+        tag = header >> 24
+        len_ = header & 0xffff
+        fd = raw_log[1]
+        spec = _update_specs(specs, tag, fd)
+        # record data follows the two header words
+        data = ctypes.addressof(raw_log.contents) + 8
+        try:
+            return LogChunk(tag, fd, len_, spec, data, bitmap.value)
+
+        except KeyError:
+            log.debug("Skipping record with unknown tag %d", tag)
+
+
+def _dispatcher(varnish_handle):
+    """ Return a function that reads the next log record with VSL_Dispatch,
+        stopping it as soon as the first record is handed to the callback.
+        Records are passed with the spec computed by libvarnishapi, before
+        filters are applied. The function returns what next() does.
+    """
+    chunks = []
+
+    def _callback(priv, tag, fd, len_, spec, ptr, bitmap):
+        try:
+            chunks.append(LogChunk(tag, fd, len_, spec, ptr, bitmap))
+
+        except KeyError:
+            log.debug("Skipping record with unknown tag %d", tag)
+            return 0
+
+        return 1
+
+    c_callback = _VSL_handler_f(_callback)
+
+    def next_():
+        result = _VSL_Dispatch(varnish_handle, c_callback, None)
+        if chunks:
+            return chunks.pop()
+
+        return None if result == 0 else False
+
+    return next_
+
+
+def iterate(varnish_handle, idle=False, dispatch=False):
+    """ Generator that yields LogChunk objects by pulling records with
+        VSL_NextLog. Like VSL_Dispatch, it tries to reopen the shared memory
+        when no records arrive for a while and stops if it cannot; if `idle`
+        is true it yields None instead and keeps waiting.
+        VSL_NextLog does not return the spec libvarnishapi tracks, which is
+        rebuilt from the records read: when filters (i.e. include_tag,
+        exclude_tag_regex, skip_first) hide the records opening connections
+        set `dispatch` to read records one at a time with VSL_Dispatch,
+        which is slower but gets client and backend flags right.
+        Stops at the end of the logs (i.e. end of file), closing the
+        generator stops reading.
+    """
+    if dispatch:
+        next_ = _dispatcher(varnish_handle)
+
+    else:
+        specs = {}
+        next_ = lambda: next(varnish_handle, specs)
+
+    while True:
+        chunk = next_()
+        if chunk is False:
+            return
+
+        if chunk is None:
+            # VSL_Dispatch already tried to reopen the shared memory
+            if not dispatch and _VSM_ReOpen(varnish_handle, 0) == 1:
+                continue
+
+            if not idle:
+                return
+
+        yield chunk
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import ctypes
+import logging
+from . import vsm
+from .logs import _LOG_TAGS
+from ..exc import VarnishException
+
+__all__ = ['LogRing']
+log = logging.getLogger(__name__)
+_SLT_RESERVED = 254
+_ENDMARKER = (_SLT_RESERVED << 24) | 0x454545
+_WRAPMARKER = (_SLT_RESERVED << 24) | 0x575757
+
+
+class LogRing(object):
+    """ Experimental reader walking the log ring (the 'Log' shared memory
+        segment) directly, bypassing VSL_Dispatch and VSL_NextLog.
+        The first word of the segment is a sequence number varnishd
+        increments every time it wraps around; records follow, each made of
+        a (tag << 24 | length) word, a file descriptor word and the data
+        padded to 32 bit words.
+        records() yields (tag code, fd, data) tuples where data is a
+        memoryview over shared memory: it is not copied, so it is only valid
+        until varnishd overwrites it, and must be copied (i.e. with
+        tobytes()) to be kept.
+        An overrun, varnishd lapping the reader, is detected from the
+        sequence number, from the position varnishd writes at when the
+        sequence number advanced by one, or from invalid records: the
+        reader then restarts
+        from the beginning of the current lap and increments `overruns`;
+        `words_lost` counts the words skipped and `records_lost` estimates
+        the records they held.
+        If `tail` is true, reading starts from the records written after
+        the ring is opened.
+    """
+
+    def __init__(self, varnish_handle, tail=True):
+        self.vd = varnish_handle
+        self.overruns = 0
+        self.laps = 0
+        self.records_read = 0
+        self.words_read = 0
+        self.words_lost = 0
+        self._attach(tail)
+
+    def _attach(self, tail):
+        chunk = vsm.find_chunk(self.vd, 'Log')
+        if chunk is None:
+            raise VarnishException('Cannot find the log segment')
+
+        address, length = chunk
+        self.vsm_seq = vsm.seq(self.vd)
+        self.words = (ctypes.c_uint32 * (length // 4)).from_address(address)
+        self.view = memoryview((ctypes.c_char * length)
+                               .from_address(address))
+        self.pos = 1
+        self.seq = self.words[0]
+        if tail:
+            self._skip_to_end()
+
+        self._mark = self.pos
+
+    def _account(self):
+        self.words_read += self.pos - self._mark
+        self._mark = self.pos
+
+    def _skip_to_end(self):
+        words = self.words
+        size = len(words)
+        pos = 1
+        while pos < size and words[pos] != _ENDMARKER:
+            if words[pos] == _WRAPMARKER or \
+               not self._valid(words[pos], pos, size):
+                pos = 1
+                break
+
+            pos += 2 + (((words[pos] & 0xffff) + 3) >> 2)
+
+        self.pos = pos
+        self.seq = words[0]
+
+    def _valid(self, header, pos, size):
+        return _LOG_TAGS[header >> 24] is not None and \
+               not header & 0xff0000 and \
+               pos + 2 + (((header & 0xffff) + 3) >> 2) < size
+
+    def _restart(self, overrun):
+        """ Move to the beginning of the ring, in the current lap """
+        self._account()
+        seq = self.words[0]
+        if overrun or seq != _next_seq(self.seq):
+            self.overruns += 1
+            laps = (seq - self.seq) & 0xffffffff
+            size = len(self.words)
+            self.words_lost += size - self.pos + max(0, laps - 1) * size
+            log.debug("Log ring overrun (seq %s -> %s)", self.seq, seq)
+
+        self.laps += 1
+        self.seq = seq
+        self.pos = self._mark = 1
+
+    def _check(self):
+        """ Reattach if the shared memory was reallocated, then look for
+            overruns from the sequence number """
+        if vsm.reopen(self.vd) or vsm.seq(self.vd) != self.vsm_seq:
+            log.debug("Log segment reallocated, reattaching")
+            self._attach(False)
+            return
+
+        seq = self.words[0]
+        if seq == self.seq:
+            return
+
+        if seq != _next_seq(self.seq) or self._writer_past(self.pos):
+            # more than a lap behind, or lapped by less than a lap
+            self._restart(True)
+
+    def _writer_past(self, limit):
+        """ Whether varnishd, in its current lap, reached word `limit`: its
+            records are walked up to the end marker. Reaching it means the
+            records the reader was about to read were overwritten, unless
+            the previous lap ended there too, which cannot be told apart.
+        """
+        words = self.words
+        size = len(words)
+        pos = 1
+        while pos < limit:
+            header = words[pos]
+            if header == _ENDMARKER:
+                return False
+
+            if header == _WRAPMARKER or not self._valid(header, pos, size):
+                # wrapped again, or overwritten while walking
+                return True
+
+            pos += 2 + (((header & 0xffff) + 3) >> 2)
+
+        return True
+
+    def records(self, limit=None):
+        """ Yield (tag code, fd, data) for the records available, at most
+            `limit`, stopping when the reader catches up with varnishd """
+        self._check()
+        words = self.words
+        view = self.view
+        size = len(words)
+        count = 0
+        try:
+            while limit is None or count < limit:
+                pos = self.pos
+                header = words[pos]
+                if header == _WRAPMARKER:
+                    self._restart(False)
+                    continue
+
+                if header == _ENDMARKER:
+                    if pos != 1 and words[0] != self.seq:
+                        # varnishd wrapped around while we were at the end
+                        self._restart(False)
+                        continue
+
+                    break
+
+                if not self._valid(header, pos, size):
+                    self._restart(True)
+                    continue
+
+                len_ = header & 0xffff
+                self.pos = pos + 2 + ((len_ + 3) >> 2)
+                count += 1
+                start = (pos + 2) * 4
+                yield header >> 24, words[pos + 1], view[start:start + len_]
+
+        finally:
+            self.records_read += count
+            self._account()
+
+    def count_tags(self, counts=None, limit=None):
+        """ Count the records available by tag code, without building any
+            view: `counts` is a list of 256 integers, updated and returned
+        """
+        if counts is None:
+            counts = [0] * 256
+
+        self._check()
+        words = self.words
+        size = len(words)
+        count = 0
+        while limit is None or count < limit:
+            pos = self.pos
+            header = words[pos]
+            if header == _WRAPMARKER:
+                self._restart(False)
+                continue
+
+            if header == _ENDMARKER:
+                if pos != 1 and words[0] != self.seq:
+                    self._restart(False)
+                    continue
+
+                break
+
+            if not self._valid(header, pos, size):
+                self._restart(True)
+                continue
+
+            counts[header >> 24] += 1
+            self.pos = pos + 2 + (((header & 0xffff) + 3) >> 2)
+            count += 1
+
+        self.records_read += count
+        self._account()
+        return counts
+
+    @property
+    def records_lost(self):
+        """ Estimated number of records lost in overruns, from the average
+            size of the records read """
+        if not self.words_read:
+            return 0
+
+        return self.words_lost * self.records_read // self.words_read
+
+    @property
+    def laps_behind(self):
+        """ Number of times varnishd wrapped around since the reader
+            started its current lap """
+        return (self.words[0] - self.seq) & 0xffffffff
+
+    def __str__(self):
+        return "<%s [%s words, seq: %s, overruns: %s]>" % (
+                    self.__class__.__name__, len(self.words), self.seq,
+                    self.overruns)
+
+    def __repr__(self):
+        return str(self)
+
+
+def _next_seq(seq):
+    """ Sequence number after seq: varnishd skips 0 when it wraps """
+    seq = (seq + 1) & 0xffffffff
+    return seq or 1
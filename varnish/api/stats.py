@@ -27,9 +27,12 @@ import logging
 from ..exc import (VarnishException,
                    VarnishUnHandledException)
 from .vsm import _VSM_data
+from . import vsm
 
 
-__all__ = ['open_', 'main', 'setup', 'init', 'iterate', 'filter_', 'exclude']
+__all__ = ['open_', 'main', 'setup', 'init', 'iterate', 'filter_', 'exclude',
+           'VarnishStatsLayout', 'VarnishStatsDescriptor',
+           'VarnishStatsDescriptors']
 varnishapi = ctypes.CDLL('libvarnishapi.so')
 log = logging.getLogger(__name__)
 
@@ -49,28 +52,118 @@ class _VSC_Point(ctypes.Structure):
                 ('ptr', ctypes.c_void_p)]
 
 
-class VarnishStatsPoint(object):
-    """ Python object used to copy the _VSC_Point structure """
-    __slots__ = ['cls', 'ident', 'name', 'flag', 'desc',
-                'value', 'full_name']
+class VarnishStatsDescriptor(object):
+    """ Immutable metadata of a counter (class, ident, name, flag,
+        description and full name), shared by all the VarnishStatsPoint
+        objects of the same counter.
+    """
+    __slots__ = ['cls', 'ident', 'name', 'flag', 'desc', 'full_name']
 
     def __init__(self, vsc_point):
-        self.cls = str(vsc_point.cls)
-        self.ident = str(vsc_point.ident)
-        self.name = str(vsc_point.name)
         assert vsc_point.fmt == 'uint64_t'
-        self.flag = chr(vsc_point.flag)
-        self.desc = str(vsc_point.desc)
+        cls = intern(str(vsc_point.cls))
+        ident = intern(str(vsc_point.ident))
+        name = intern(str(vsc_point.name))
+        full_name = ".".join(p for p in (cls, ident, name) if p)
+        object.__setattr__(self, "cls", cls)
+        object.__setattr__(self, "ident", ident)
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "flag", chr(vsc_point.flag))
+        object.__setattr__(self, "desc", str(vsc_point.desc))
+        object.__setattr__(self, "full_name", intern(full_name))
+
+    def __str__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.full_name)
+
+    def __repr__(self):
+        return "<%s %s [%s]>" % (self.__class__.__name__, self.full_name,
+                                 self.desc)
+
+    def __setattr__(self, attr, value):
+        raise TypeError("'%s' object does not support "
+                        "attribute assignment" % (self.__class__.__name__))
+
+
+class VarnishStatsDescriptors(object):
+    """ Cache of the VarnishStatsDescriptor objects of the counters of a
+        handle, keyed by the address of the counter in shared memory.
+        The cache is emptied when the allocation sequence number of the
+        shared memory changes; if libvarnishapi does not expose it, nothing
+        is cached.
+    """
+
+    def __init__(self, varnish_handle):
+        self.vd = varnish_handle
+        self.seq = None
+        self._descriptors = {}
+
+    def refresh(self):
+        """ Empty the cache if the shared memory changed """
+        seq = vsm.seq(self.vd)
+        if seq is None or seq != self.seq:
+            self._descriptors.clear()
+
+        self.seq = seq
+
+    def clear(self):
+        """ Empty the cache, i.e. after the shared memory was reopened """
+        self._descriptors.clear()
+        self.seq = None
+
+    def get(self, vsc_point):
+        """ Return the descriptor of a _VSC_Point """
+        descriptor = self._descriptors.get(vsc_point.ptr)
+        if descriptor is None:
+            descriptor = VarnishStatsDescriptor(vsc_point)
+            if self.seq is not None:
+                self._descriptors[vsc_point.ptr] = descriptor
+
+        return descriptor
+
+    def __len__(self):
+        return len(self._descriptors)
+
+    def __str__(self):
+        return "<%s [seq: %s, %s cached]>" % (self.__class__.__name__,
+                                              self.seq, len(self))
+
+    def __repr__(self):
+        return str(self)
+
+
+class VarnishStatsPoint(object):
+    """ Value of a counter, with its metadata in a shared
+        VarnishStatsDescriptor """
+    __slots__ = ['descriptor', 'value']
+
+    def __init__(self, vsc_point, descriptor=None):
+        self.descriptor = descriptor or VarnishStatsDescriptor(vsc_point)
         self.value = long(ctypes.cast(vsc_point.ptr,
                                       ctypes.POINTER(ctypes.c_ulong))[0])
-        self.full_name = ""
-        if self.cls:
-            self.full_name = self.full_name + "%s." % (self.cls)
 
-        if self.ident:
-            self.full_name = self.full_name + "%s." % (self.ident)
+    @property
+    def cls(self):
+        return self.descriptor.cls
+
+    @property
+    def ident(self):
+        return self.descriptor.ident
+
+    @property
+    def name(self):
+        return self.descriptor.name
 
-        self.full_name = self.full_name + self.name
+    @property
+    def flag(self):
+        return self.descriptor.flag
+
+    @property
+    def desc(self):
+        return self.descriptor.desc
+
+    @property
+    def full_name(self):
+        return self.descriptor.full_name
 
     def __str__(self):
         return "<%s %s = %s>" % (self.__class__.__name__, self.full_name,
@@ -86,6 +179,83 @@ class VarnishStatsPoint(object):
         return self.full_name == other.full_name
 
 
+class VarnishStatsLayout(object):
+    """ Position in shared memory and metadata of the counters selected by
+        the filters set on the handle, collected walking VSC_Iter once.
+        read() then copies the current values of all the counters straight
+        from shared memory, with a single memmove for every run of adjacent
+        counters. The layout is valid until the shared memory is reopened
+        or its allocation sequence number (`seq`) changes.
+        Counters metadata is taken from `descriptors`, a
+        VarnishStatsDescriptors cache, if given.
+    """
+
+    def __init__(self, varnish_handle, descriptors=None):
+        self.seq = vsm.seq(varnish_handle)
+        self.points = []
+        addresses = []
+        if descriptors is not None:
+            descriptors.refresh()
+
+        def _callback(priv, point):
+            try:
+                if point:
+                    descriptor = descriptors.get(point[0]) \
+                                 if descriptors is not None else None
+                    self.points.append(VarnishStatsPoint(point[0],
+                                                         descriptor))
+                    addresses.append(point[0].ptr)
+
+            except Exception as e:
+                _callback.exception = e
+                return 1
+
+            return 0
+
+        _callback.exception = None
+        c_callback = _VSC_iter_f(_callback)
+        _VSC_Iter(varnish_handle, c_callback, None)
+        if _callback.exception:
+            raise _callback.exception
+
+        runs = []
+        size = ctypes.sizeof(ctypes.c_uint64)
+        for index, address in enumerate(addresses):
+            if runs and runs[-1][1] + runs[-1][2] == address:
+                offset, start, length = runs[-1]
+                runs[-1] = (offset, start, length + size)
+
+            else:
+                runs.append((index * size, address, size))
+
+        self.runs = tuple(runs)
+
+    def values(self):
+        """ Return a new array of counters values, suitable for read() """
+        return (ctypes.c_uint64 * len(self.points))()
+
+    def read(self, values):
+        """ Copy the current counters values into `values`, an array as
+            returned by values(). Returns `values`.
+        """
+        base = ctypes.addressof(values)
+        memmove = ctypes.memmove
+        for offset, address, length in self.runs:
+            memmove(base + offset, address, length)
+
+        return values
+
+    def __len__(self):
+        return len(self.points)
+
+    def __str__(self):
+        return "<%s [%s counters, %s runs]>" % (self.__class__.__name__,
+                                                len(self), len(self.runs))
+
+    def __repr__(self):
+        return str(self)
+
+
 # stats
 _VSC_Setup = varnishapi.VSC_Setup
 _VSC_Setup.argtypes = [ctypes.POINTER(_VSM_data)]
@@ -138,12 +308,25 @@ def init(varnish_handle, diagnostic=False):
     return main(varnish_handle)
 
 
-def iterate(varnish_handle, callback, private_data=None):
+def iterate(varnish_handle, callback, private_data=None, descriptors=None):
     """ Iterate over all statistics counters calling callback for each counters
-        not filtered out by pre-set filters
+        not filtered out by pre-set filters.
+        Counters metadata is taken from `descriptors`, a
+        VarnishStatsDescriptors cache, if given.
     """
+    if descriptors is not None:
+        descriptors.refresh()
+
     def _callback(priv, point):
-        value = VarnishStatsPoint(point[0]) if not point is None else None
+        if point is None:
+            value = None
+
+        elif descriptors is not None:
+            value = VarnishStatsPoint(point[0], descriptors.get(point[0]))
+
+        else:
+            value = VarnishStatsPoint(point[0])
+
         if priv:
             priv = ctypes.cast(priv, ctypes.py_object).value
 
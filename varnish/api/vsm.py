@@ -30,7 +30,7 @@ from ..exc import VarnishException
 log = logging.getLogger(__name__)
 __all__ = ['init', 'open', 'reopen', 'close', 'delete',
            'clear_diagnostic_function', 'set_diagnostic_function',
-           'access_instance']
+           'access_instance', 'seq', 'find_chunk']
 varnishapi = ctypes.CDLL('libvarnishapi.so')
 
 
@@ -68,6 +68,24 @@ _VSM_Delete = varnishapi.VSM_Close
 _VSM_Delete.argtypes = [ctypes.POINTER(_VSM_data)]
 _VSM_Delete.restype = None
 
+try:
+    _VSM_Seq = varnishapi.VSM_Seq
+    _VSM_Seq.argtypes = [ctypes.POINTER(_VSM_data)]
+    _VSM_Seq.restype = ctypes.c_uint
+
+except AttributeError:
+    _VSM_Seq = None
+
+try:
+    _VSM_Find_Chunk = varnishapi.VSM_Find_Chunk
+    _VSM_Find_Chunk.argtypes = [ctypes.POINTER(_VSM_data), ctypes.c_char_p,
+                                ctypes.c_char_p, ctypes.c_char_p,
+                                ctypes.POINTER(ctypes.c_uint)]
+    _VSM_Find_Chunk.restype = ctypes.c_void_p
+
+except AttributeError:
+    _VSM_Find_Chunk = None
+
 
 def init():
     """ Allocate and initialize the handle used in the C API.
@@ -91,11 +109,16 @@ def open(varnish_handle, diagnostic=False):
 
 
 def reopen(varnish_handle, diagnostic=False):
+    """ Check if the shared memory file changed, reopening it if needed.
+        Returns True if it was reopened
+    """
     diag = 1 if diagnostic else 0
     res = _VSM_ReOpen(varnish_handle, diag)
     if res < 0:
         raise VarnishException('Failed to reopen and remap shared memory file')
 
+    return res == 1
+
 
 def close(varnish_handle):
     _VSM_Close(varnish_handle)
@@ -125,6 +148,32 @@ def clear_diagnostic_function(varnish_handle):
     _VSM_Diag(varnish_handle, None, None)
 
 
+def seq(varnish_handle):
+    """ Return the allocation sequence number of the shared memory, which
+        changes whenever its segments are reallocated.
+        Returns None if libvarnishapi does not support it
+    """
+    if _VSM_Seq is None:
+        return None
+
+    return _VSM_Seq(varnish_handle)
+
+
+def find_chunk(varnish_handle, class_, type_='', ident=''):
+    """ Return the (address, length) of a shared memory segment, i.e.
+        find_chunk(vd, 'Log') for the log ring, None if it is not found """
+    if _VSM_Find_Chunk is None:
+        raise VarnishException('VSM_Find_Chunk not supported by libvarnishapi')
+
+    length = ctypes.c_uint(0)
+    address = _VSM_Find_Chunk(varnish_handle, class_, type_, ident,
+                              ctypes.byref(length))
+    if not address:
+        return None
+
+    return address, length.value
+
+
 def access_instance(varnish_handle, instance_name):
     """ Configure which varnish instance to access """
     if _VSM_n_Arg(varnish_handle, instance_name) != 1:
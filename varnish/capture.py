@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+
+import collections
+import gzip
+import logging
+import mmap
+import multiprocessing
+import os
+import Queue
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from . import vsl
+from .exc import VarnishException
+from .logs import request_dispatcher
+
+__all__ = ['CaptureFile', 'CaptureWriter']
+log = logging.getLogger(__name__)
+# record header: tag << 24 | length, file descriptor
+_HEADER = struct.Struct('=II')
+# number of consecutive valid headers needed to find a record boundary
+_SYNC_RECORDS = 8
+# the tags table chunks are built with: importing .logs above replaced the
+# static one with libvarnishapi's, if available
+_tags = vsl.LogChunk.tags
+# tags marking a file descriptor as a client or backend connection, as
+# VSL_NextLog does. BackendReuse only appears on backend connections: use it
+# to recognize connections opened before the part of the file being read
+_SLT_CLIENT_START = frozenset(_tags[name].code
+                              for name in ('sessionopen', 'reqstart'))
+_SLT_BACKEND_START = frozenset(_tags[name].code for name in
+                               ('backendopen', 'backendxid', 'backendreuse'))
+# records always written by CaptureWriter, needed to assemble requests
+_LIFECYCLE_TAGS = frozenset(_tags[name].code for name in
+                            ('sessionopen', 'sessionclose', 'reqstart',
+                             'reqend', 'backendopen', 'backendxid',
+                             'backendreuse', 'backendclose'))
+
+
+class CaptureFile(object):
+    """ Reads files written by `varnishlog -w` without libvarnishapi: the
+        file is memory mapped and records headers (tag, length and file
+        descriptor) are walked directly.
+        Chunks and requests are the same LogChunk and RequestLog objects
+        read from shared memory, with client and backend flags tracked as
+        VSL_Dispatch does.
+        Files ending in .gz (i.e. segments compressed by CaptureWriter) are
+        decompressed once, to a temporary file which is mapped instead (and
+        read by process() workers) until the CaptureFile is closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        if path.endswith('.gz'):
+            self._file = tempfile.NamedTemporaryFile(prefix='varnish-',
+                                                     suffix='.log')
+            try:
+                with gzip.open(path, 'rb') as src:
+                    shutil.copyfileobj(src, self._file, 1 << 20)
+
+                self._file.flush()
+
+            except:
+                self._file.close()
+                raise
+
+        else:
+            self._file = open(path, 'rb')
+
+        # path of the uncompressed records
+        self._records_path = self._file.name
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def find_record(self, offset):
+        """ Return the offset of the first record starting at or after
+            `offset`, the size of the file if there is none.
+            Records carry no marker: a record is recognized as the first of
+            a sequence of valid headers.
+        """
+        offset = max(0, offset) & ~3
+        while offset < self.size:
+            if self._valid_records(offset, _SYNC_RECORDS):
+                return offset
+
+            offset += 4
+
+        return self.size
+
+    def _valid_records(self, offset, count):
+        data = self._map
+        size = self.size
+        tags = vsl.LogChunk.tags_by_code
+        for _ in xrange(count):
+            if offset == size:
+                return True
+
+            if offset + 8 > size:
+                return False
+
+            header, fd = _HEADER.unpack_from(data, offset)
+            len_ = header & 0xffff
+            if tags[header >> 24] is None or header & 0xff0000 or \
+               offset + 8 + len_ > size:
+                return False
+
+            offset += 8 + ((len_ + 3) & ~3)
+
+        return True
+
+    def split(self, parts):
+        """ Return up to `parts` (start, end) offsets ranges covering the
+            file, of about the same size, split at records boundaries """
+        if not self.size:
+            return []
+
+        offsets = [0]
+        for i in xrange(1, parts):
+            offset = self.find_record(self.size * i // parts)
+            if offset > offsets[-1]:
+                offsets.append(offset)
+
+        offsets.append(self.size)
+        return zip(offsets[:-1], offsets[1:])
+
+    def iter_chunks(self, start=0, end=None, offsets=False):
+        """ Yield the LogChunk objects of the records starting from offset
+            `start` (which must be the offset of a record) up to offset
+            `end` (the end of file by default).
+            If `offsets` is true, yield (offset, LogChunk) tuples.
+        """
+        data = self._map
+        size = self.size
+        end = size if end is None else min(end, size)
+        unpack = _HEADER.unpack_from
+        client_start = _SLT_CLIENT_START
+        backend_start = _SLT_BACKEND_START
+        client = vsl.VSL_S_CLIENT
+        backend = vsl.VSL_S_BACKEND
+        LogChunk = vsl.LogChunk
+        specs = {}
+        pos = start
+        while pos < end:
+            if pos + 8 > size:
+                log.warning("%s: truncated record at offset %d", self.path,
+                            pos)
+                return
+
+            header, fd = unpack(data, pos)
+            tag = header >> 24
+            len_ = header & 0xffff
+            if pos + 8 + len_ > size:
+                log.warning("%s: truncated record at offset %d", self.path,
+                            pos)
+                return
+
+            if tag in client_start:
+                specs[fd] = client
+
+            elif tag in backend_start:
+                specs[fd] = backend
+
+            try:
+                chunk = LogChunk(tag, fd, len_, specs.get(fd, 0),
+                                 data[pos + 8:pos + 8 + len_], 0)
+
+            except KeyError:
+                raise VarnishException("%s: invalid record tag %d at offset "
+                                       "%d" % (self.path, tag, pos))
+
+            yield (pos, chunk) if offsets else chunk
+            # records are padded to 32 bit words
+            pos += 8 + ((len_ + 3) & ~3)
+
+    def dispatch_chunks(self, callback, start=0, end=None):
+        """ Call callback for every LogChunk, stopping if it returns False
+        """
+        for chunk in self.iter_chunks(start, end):
+            if callback(chunk) is False:
+                return
+
+    def dispatch_requests(self, callback, aggregate=1000,
+                          nonrequest_callback=None, assembler=None,
+                          fields=None, keep_chunks=True, monitor=None):
+        """ Call callback for every complete RequestLog, as
+            VarnishLogs.dispatch_requests() does """
+        if monitor is not None:
+            # lag is meaningless for records read from a file
+            monitor.live = False
+
+        cb = request_dispatcher(callback, aggregate, nonrequest_callback,
+                                assembler, fields, keep_chunks, monitor)
+        self.dispatch_chunks(cb)
+
+    def iter_requests(self, start=0, end=None, overlap=0, **kwargs):
+        """ Yield complete RequestLog objects completed by records between
+            offsets `start` and `end`. Reading starts `overlap` bytes before
+            `start`, so that requests begun before it are complete.
+            `kwargs` are passed to dispatch_requests()
+        """
+        requests = collections.deque()
+        if kwargs.get('monitor') is not None:
+            kwargs['monitor'].live = False
+
+        cb = request_dispatcher(requests.append, **kwargs)
+        first = self.find_record(start - overlap) if overlap else start
+        for offset, chunk in self.iter_chunks(min(first, start), end, True):
+            cb(chunk)
+            if not requests:
+                continue
+
+            if offset < start:
+                requests.clear()
+                continue
+
+            while requests:
+                yield requests.popleft()
+
+    def process(self, aggregate, reducer, processes=None, parts=None,
+                overlap=8 << 20, **kwargs):
+        """ Process the file in parallel with a multiprocessing pool of
+            `processes` processes (one per CPU by default).
+            The file is split in `parts` parts (4 per process by default);
+            every part is processed by calling `aggregate`, which must be a
+            picklable function, with an iterator of the complete RequestLog
+            objects of that part (see iter_requests(), which is called with
+            `overlap` and `kwargs`). Results are combined, in file order,
+            calling `reducer` with two results at a time.
+            Requests lasting longer than the `overlap` bytes before a part
+            may be lost.
+        """
+        processes = processes or multiprocessing.cpu_count()
+        ranges = self.split(parts or processes * 4)
+        if not ranges:
+            return aggregate(iter(()))
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_process_part,
+                               [(self._records_path, start, end, overlap,
+                                 aggregate, kwargs) for start, end in ranges],
+                               chunksize=1)
+
+        finally:
+            pool.close()
+            pool.join()
+
+        return reduce(reducer, results)
+
+    def close(self):
+        if self._file is not None:
+            if self._map is not None:
+                self._map.close()
+
+            self._file.close()
+            self._file = None
+
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __str__(self):
+        return "<%s [%s, %s bytes]>" % (self.__class__.__name__, self.path,
+                                        self.size)
+
+    def __repr__(self):
+        return str(self)
+
+
+class CaptureWriter(object):
+    """ Writes LogChunk objects in the `varnishlog -w` format, so that they
+        can be read by CaptureFile or varnishlog -r. It is a callable
+        suitable for VarnishLogs.dispatch_chunks().
+        Records are encoded by the caller and batched; batches are written
+        by a background thread when they reach `batch_size` bytes or are
+        older than `max_latency` seconds, even if no more records are
+        written. When the thread falls behind by `max_batches` batches the
+        caller blocks.
+        Files are named after `path`, formatted with time.strftime when they
+        are opened, and are rotated when bigger than `max_size` bytes or
+        older than `max_age` seconds. If `compress` is true, closed files
+        are gzipped (to name + '.gz') by another background thread.
+        Only the records with a tag in `tags` (names) are written, if set,
+        but the records starting and ending sessions and requests are
+        always kept so that requests can be assembled when reading. Records
+        of backend requests and records not related to requests are
+        skipped if `backend` or `nonrequest` are false.
+    """
+
+    def __init__(self, path='varnish-%Y%m%d-%H%M%S.log', max_size=None,
+                 max_age=None, compress=False, compress_level=6, tags=None,
+                 backend=True, nonrequest=True, batch_size=64 << 10,
+                 max_latency=1, max_batches=64):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.compress = compress
+        self.compress_level = compress_level
+        self.tags = None
+        if tags is not None:
+            tags = frozenset(_tags[name.lower()].code
+                             for name in tags)
+            self.tags = tags | _LIFECYCLE_TAGS
+
+        self.backend = backend
+        self.nonrequest = nonrequest
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.records = 0
+        self.files = []
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_started = None
+        # guards the current batch, shared with the background thread
+        self._lock = threading.Lock()
+        self._file = None
+        self._opened_at = None
+        self._written = 0
+        self._closed = False
+        self._batches = Queue.Queue(max_batches)
+        self._writer = threading.Thread(target=self._write_batches)
+        self._writer.daemon = True
+        self._writer.start()
+        self._compressor = None
+        if compress:
+            self._compress_queue = Queue.Queue()
+            self._compressor = threading.Thread(target=self._compress_files)
+            self._compressor.daemon = True
+            self._compressor.start()
+
+    def __call__(self, chunk):
+        self.write(chunk)
+
+    def write(self, chunk):
+        """ Write a LogChunk, unless it is filtered out """
+        if self.tags is not None and chunk.tag.code not in self.tags:
+            return
+
+        if chunk.fd == 0:
+            if not self.nonrequest:
+                return
+
+        elif chunk.backend and not self.backend:
+            return
+
+        data = chunk.data
+        len_ = len(data)
+        record = _HEADER.pack(chunk.tag.code << 24 | len_, chunk.fd) + \
+                 data + '\0' * (-len_ & 3)
+        with self._lock:
+            self._batch.append(record)
+            self._batch_bytes += len(record)
+            self.records += 1
+            now = time.time()
+            if self._batch_started is None:
+                self._batch_started = now
+
+            if self._batch_bytes >= self.batch_size or \
+               now - self._batch_started >= self.max_latency:
+                self._flush()
+
+    def flush(self):
+        """ Queue the current batch for writing """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            self._batches.put(''.join(self._batch))
+            self._batch = []
+            self._batch_bytes = 0
+            self._batch_started = None
+
+    def _take_late_batch(self, now):
+        """ Return the current batch if older than max_latency, taking it
+            from the caller, '' otherwise. Queued batches are written first,
+            and the caller is never waited for: it might be blocked queueing
+            a batch to this thread.
+        """
+        if self.max_latency is None or not self._lock.acquire(False):
+            return ''
+
+        try:
+            if not self._batch or not self._batches.empty() or \
+               now - self._batch_started < self.max_latency:
+                return ''
+
+            batch = ''.join(self._batch)
+            self._batch = []
+            self._batch_bytes = 0
+            self._batch_started = None
+            return batch
+
+        finally:
+            self._lock.release()
+
+    def _write_batches(self):
+        timeout = min(1, self.max_latency) if self.max_latency else 1
+        while True:
+            try:
+                batch = self._batches.get(timeout=timeout)
+
+            except Queue.Empty:
+                batch = self._take_late_batch(time.time())
+
+            if batch is None:
+                self._close_file()
+                return
+
+            now = time.time()
+            if self._file is not None and \
+               ((self.max_size and self._written >= self.max_size) or
+                (self.max_age and now - self._opened_at >= self.max_age)):
+                self._close_file()
+
+            if not batch:
+                continue
+
+            if self._file is None:
+                self._open_file(now)
+
+            try:
+                self._file.write(batch)
+                self._written += len(batch)
+                if self._batches.empty():
+                    # nothing else to write: do not keep records buffered
+                    self._file.flush()
+
+            except IOError as e:
+                log.error("Cannot write to %s: %s", self._file.name, e)
+
+    def _open_file(self, now):
+        name = time.strftime(self.path, time.localtime(now))
+        base, ext = os.path.splitext(name)
+        n = 0
+        while os.path.exists(name) or os.path.exists(name + '.gz'):
+            n += 1
+            name = "%s.%d%s" % (base, n, ext)
+
+        self._file = open(name, 'wb')
+        self._opened_at = now
+        self._written = 0
+        log.debug("Writing logs to %s", name)
+
+    def _close_file(self):
+        if self._file is None:
+            return
+
+        self._file.close()
+        name = self._file.name
+        self._file = None
+        if self.compress:
+            self._compress_queue.put(name)
+
+        else:
+            self.files.append(name)
+
+    def _compress_files(self):
+        while True:
+            name = self._compress_queue.get()
+            if name is None:
+                return
+
+            try:
+                with open(name, 'rb') as src:
+                    with gzip.open(name + '.gz', 'wb',
+                                   self.compress_level) as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+
+                os.remove(name)
+                self.files.append(name + '.gz')
+
+            except (IOError, OSError) as e:
+                log.error("Cannot compress %s: %s", name, e)
+                self.files.append(name)
+
+    def close(self):
+        """ Write pending records, close the current file and wait for
+            compressions to complete """
+        if self._closed:
+            return
+
+        self._closed = True
+        self.flush()
+        self._batches.put(None)
+        self._writer.join()
+        if self._compressor is not None:
+            self._compress_queue.put(None)
+            self._compressor.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __str__(self):
+        return "<%s [%s, %s records, %s files]>" % (self.__class__.__name__,
+                                                     self.path, self.records,
+                                                     len(self.files))
+
+    def __repr__(self):
+        return str(self)
+
+
+def _process_part(args):
+    # path is the uncompressed file, also for .gz captures
+    path, start, end, overlap, aggregate, kwargs = args
+    with CaptureFile(path) as capture:
+        return aggregate(capture.iter_requests(start, end, overlap,
+                                               **kwargs))
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+from . import Instance
+
+__all__ = ['StatsCollector', 'CollectedStats']
+log = logging.getLogger(__name__)
+
+
+class StatsCollector(object):
+    """ Reads the stats of several varnish instances (given by name, None
+        is the default instance) concurrently, using a pool of `threads`
+        threads (one per instance by default).
+        Instances which cannot be opened or read are closed and reopened in
+        a background thread every `retry_interval` seconds, while the
+        others keep being read.
+    """
+
+    def __init__(self, names, threads=None, retry_interval=5):
+        self.names = list(names)
+        self.retry_interval = retry_interval
+        self._pool = ThreadPool(threads or len(self.names) or 1)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._retry_thread = None
+        self._instances = {}
+        self._failed = {}
+        for name in self.names:
+            self._open(name)
+
+    def _open(self, name):
+        instance = Instance(name)
+        try:
+            instance.init()
+            instance.stats.view()
+
+        except Exception as e:
+            log.debug("Cannot open instance %s: %s", instance.name, e)
+            self._fail(name, instance, e)
+            return False
+
+        with self._lock:
+            self._instances[name] = instance
+            self._failed.pop(name, None)
+
+        return True
+
+    def _fail(self, name, instance, exception):
+        if instance.vd:
+            try:
+                instance.close()
+
+            except Exception:
+                pass
+
+        with self._lock:
+            self._instances.pop(name, None)
+            self._failed[name] = exception
+            if self._closed.is_set() or self._retry_thread is not None:
+                return
+
+            self._retry_thread = threading.Thread(target=self._retry)
+            self._retry_thread.daemon = True
+            self._retry_thread.start()
+
+    def _retry(self):
+        while not self._closed.wait(self.retry_interval):
+            with self._lock:
+                failed = list(self._failed)
+                if not failed:
+                    self._retry_thread = None
+                    return
+
+            for name in failed:
+                if self._closed.is_set():
+                    return
+
+                self._open(name)
+
+    def _read(self, item):
+        name, instance = item
+        started = time.time()
+        try:
+            reading = instance.stats.view().snapshot()
+
+        except Exception as e:
+            log.debug("Cannot read instance %s: %s", instance.name, e)
+            self._fail(name, instance, e)
+            return name, None, time.time() - started, e
+
+        return name, reading, time.time() - started, None
+
+    def collect(self):
+        """ Read the stats of all the instances, returning a CollectedStats
+        """
+        with self._lock:
+            items = self._instances.items()
+            errors = dict(self._failed)
+
+        readings = {}
+        latencies = {}
+        for name, reading, latency, error in self._pool.map(self._read,
+                                                            items):
+            latencies[name] = latency
+            if error is None:
+                readings[name] = reading
+
+            else:
+                errors[name] = error
+
+        return CollectedStats(readings, latencies, errors)
+
+    @property
+    def failed(self):
+        """ Names of the instances currently not being read """
+        with self._lock:
+            return list(self._failed)
+
+    def close(self):
+        self._closed.set()
+        self._pool.close()
+        self._pool.join()
+        with self._lock:
+            instances = self._instances.values()
+            self._instances.clear()
+
+        for instance in instances:
+            instance.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __str__(self):
+        return "<%s [instances: %s, failed: %s]>" % (self.__class__.__name__,
+                                                     len(self.names),
+                                                     len(self.failed))
+
+    def __repr__(self):
+        return str(self)
+
+
+class CollectedStats(collections.Mapping):
+    """ Readings of several instances taken by StatsCollector.collect(),
+        mapping instance names to VarnishStatsArrayReading objects.
+        `latencies` maps instance names to the seconds their read took,
+        `errors` maps the names of instances not read to the exception
+        raised.
+    """
+
+    def __init__(self, readings, latencies, errors):
+        self.timestamp = datetime.datetime.utcnow()
+        self.readings = readings
+        self.latencies = latencies
+        self.errors = errors
+
+    def iter_values(self):
+        """ Yield (instance name, full_name, value) for every counter of
+            every instance """
+        for name, reading in self.readings.iteritems():
+            for full_name, value in zip(reading.schema.names,
+                                        reading.values):
+                yield name, full_name, value
+
+    def __getitem__(self, key):
+        return self.readings[key]
+
+    def __iter__(self):
+        return iter(self.readings)
+
+    def __len__(self):
+        return len(self.readings)
+
+    def __str__(self):
+        return "<%s[%s] - %s instances, %s errors>" % (
+                    self.__class__.__name__, self.timestamp, len(self),
+                    len(self.errors))
+
+    def __repr__(self):
+        return str(self)
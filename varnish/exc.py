@@ -24,7 +24,7 @@ WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 __all__ = ['VarnishUnHandledException', 'VarnishException',
-           'VarnishUninitializedError']
+           'VarnishUninitializedError', 'StreamClosed']
 
 
 class VarnishException(Exception):
@@ -37,3 +37,7 @@ class VarnishUnHandledException(VarnishException):
 
 class VarnishUninitializedError(VarnishException):
     pass
+
+
+class StreamClosed(VarnishException):
+    pass
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import abc
+import calendar
+import logging
+import math
+import re
+import socket
+import threading
+import time
+from .stats import VarnishStatsArrayReading, VarnishStatsDelta
+
+__all__ = ['StatsdExporter', 'GraphiteExporter']
+log = logging.getLogger(__name__)
+_INVALID_CHARS = re.compile(r'[^a-zA-Z0-9_\-]')
+
+
+def _metric_name(prefix, point):
+    """ Return the dotted name of a counter: prefix.cls.ident.name, leaving
+        out empty parts """
+    parts = [prefix] if prefix else []
+    parts.extend(_INVALID_CHARS.sub('_', p)
+                 for p in (point.cls, point.ident, point.name) if p)
+    return '.'.join(parts)
+
+
+class _Exporter(object):
+    """ Base class for exporters: subclasses implement export() and send() """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.exported = 0
+        self._names = (None, None)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _metric_names(self, points):
+        key, names = self._names
+        if key is not points:
+            names = [_metric_name(self.prefix, p) for p in points]
+            self._names = (points, names)
+
+        return names
+
+    @abc.abstractmethod
+    def export(self, reading):
+        """ Export a VarnishStatsReading, VarnishStatsArrayReading or
+            VarnishStatsDelta """
+
+    def run(self, source, interval):
+        """ Export what `source`, a callable returning readings (i.e.
+            instance.stats.view().snapshot), returns every `interval`
+            seconds until stop() is called. Exports are scheduled on a
+            fixed grid, so they do not drift; missed ones are skipped.
+        """
+        deadline = time.time()
+        while not self._stopped.is_set():
+            try:
+                self.export(source())
+
+            except Exception:
+                log.exception("Cannot export stats")
+
+            deadline += interval
+            now = time.time()
+            if deadline < now:
+                deadline += interval * math.ceil((now - deadline) / interval)
+
+            self._stopped.wait(deadline - now)
+
+    def start(self, source, interval):
+        """ Call run() in a background thread """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run,
+                                        args=(source, interval))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+
+    def __str__(self):
+        return "<%s [exported: %s]>" % (self.__class__.__name__,
+                                        self.exported)
+
+    def __repr__(self):
+        return str(self)
+
+
+def _points(reading):
+    if isinstance(reading, (VarnishStatsArrayReading, VarnishStatsDelta)):
+        return reading.schema.points, reading.values
+
+    points = reading.values()
+    return points, [p.value for p in points]
+
+
+def _absolute(reading, values):
+    """ Return the absolute values of the counters: for a
+        VarnishStatsDelta those of its newer reading, None if unknown """
+    if isinstance(reading, VarnishStatsDelta):
+        newer = reading.reading
+        return newer.values if newer is not None else None
+
+    return values
+
+
+class StatsdExporter(_Exporter):
+    """ Sends counters to statsd over UDP, packing as many metrics as they
+        fit in datagrams of `mtu` bytes.
+        Accumulating counters are sent as statsd counters, incremented by
+        the difference from the previous reading exported (or by the values
+        of a VarnishStatsDelta), the others as gauges set to their absolute
+        value. Counters lower than before, reset by a varnish restart, are
+        incremented by their new value (skipped for a VarnishStatsDelta not
+        knowing it).
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='varnish',
+                 mtu=1432):
+        super(StatsdExporter, self).__init__(prefix)
+        self.address = (host, port)
+        self.mtu = mtu
+        self.datagrams = 0
+        self._previous = {}
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def export(self, reading):
+        points, values = _points(reading)
+        absolute = _absolute(reading, values)
+        names = self._metric_names(points)
+        delta = isinstance(reading, VarnishStatsDelta)
+        previous = self._previous
+        current = {}
+        lines = []
+        for i, (name, point, value) in enumerate(zip(names, points, values)):
+            if point.flag != 'a':
+                if absolute is not None:
+                    lines.append("%s:%s|g" % (name, absolute[i]))
+
+                continue
+
+            if delta:
+                if value < 0:
+                    # the counter was reset: send its new value, if known
+                    if absolute is None:
+                        continue
+
+                    value = absolute[i]
+
+            else:
+                current[name] = value
+                old = previous.get(name)
+                if old is None:
+                    continue
+
+                # counters lower than before were reset
+                value = value - old if value >= old else value
+
+            if value:
+                lines.append("%s:%s|c" % (name, value))
+
+        if not delta:
+            self._previous = current
+
+        self.send(lines)
+
+    def send(self, lines):
+        """ Send statsd lines packed in datagrams """
+        datagram = []
+        size = 0
+        for line in lines:
+            if datagram and size + len(line) + 1 > self.mtu:
+                self._send_datagram(datagram)
+                datagram = []
+                size = 0
+
+            datagram.append(line)
+            size += len(line) + 1
+
+        if datagram:
+            self._send_datagram(datagram)
+
+        self.exported += len(lines)
+
+    def _send_datagram(self, lines):
+        try:
+            self._socket.sendto('\n'.join(lines), self.address)
+            self.datagrams += 1
+
+        except socket.error as e:
+            log.debug("Cannot send datagram to %s: %s", self.address, e)
+
+    def close(self):
+        super(StatsdExporter, self).close()
+        self._socket.close()
+
+
+class GraphiteExporter(_Exporter):
+    """ Sends counters values to Graphite with the plaintext protocol over
+        TCP, writing `buffer_size` bytes at a time. The connection is opened
+        on first export and reopened after errors.
+        For a VarnishStatsDelta, accumulating counters are sent as deltas
+        and the others with the absolute values of its newer reading, as
+        are counters reset by a varnish restart (or skipped, if the newer
+        reading is not known).
+    """
+
+    def __init__(self, host='localhost', port=2003, prefix='varnish',
+                 buffer_size=65536, timeout=10):
+        super(GraphiteExporter, self).__init__(prefix)
+        self.address = (host, port)
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self._socket = None
+
+    def export(self, reading):
+        points, values = _points(reading)
+        absolute = _absolute(reading, values)
+        names = self._metric_names(points)
+        if isinstance(reading, VarnishStatsDelta) and \
+           reading.reading is not None:
+            reading = reading.reading
+
+        timestamp = calendar.timegm(reading.timestamp.utctimetuple()) \
+                    if hasattr(reading, 'timestamp') else int(time.time())
+        suffix = " %d\n" % (timestamp)
+        lines = []
+        for i, (name, point, value) in enumerate(zip(names, points, values)):
+            if point.flag != 'a' or value < 0:
+                # gauges and reset counters are sent with their absolute
+                # value, if known
+                if absolute is None:
+                    continue
+
+                value = absolute[i]
+
+            lines.append("%s %s%s" % (name, value, suffix))
+
+        self.send(lines)
+
+    def send(self, lines):
+        """ Send plaintext protocol lines """
+        buf = []
+        size = 0
+        count = 0
+        try:
+            for line in lines:
+                buf.append(line)
+                size += len(line)
+                count += 1
+                if size >= self.buffer_size:
+                    self._write(''.join(buf))
+                    buf = []
+                    size = 0
+
+            if buf:
+                self._write(''.join(buf))
+
+        except socket.error as e:
+            log.debug("Cannot send metrics to %s: %s", self.address, e)
+            self._disconnect()
+            return
+
+        self.exported += count
+
+    def _write(self, data):
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address,
+                                                    self.timeout)
+
+        self._socket.sendall(data)
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def close(self):
+        super(GraphiteExporter, self).close()
+        self._disconnect()
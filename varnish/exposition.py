@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import BaseHTTPServer
+import collections
+import logging
+import re
+import SocketServer
+import threading
+import time
+import weakref
+from .stats import VarnishStatsArrayReading
+
+__all__ = ['render', 'ExpositionCache', 'MetricsServer', 'CONTENT_TYPE']
+log = logging.getLogger(__name__)
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+_INVALID_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+# label used for the ident of counters in some classes
+_IDENT_LABELS = {
+    'VBE': 'backend',
+    'SMA': 'storage',
+    'SMF': 'storage',
+}
+
+
+def _metric_name(prefix, cls, name):
+    parts = [prefix, cls, name] if cls else [prefix, name]
+    return _INVALID_CHARS.sub('_', '_'.join(parts)).lower()
+
+
+def _escape_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"')\
+                .replace('\n', r'\n')
+
+
+def _escape_help(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n')
+
+
+class _Template(object):
+    """ Everything but the values of the exposition of a list of counters:
+        families headers and the metric name and labels of every sample,
+        grouped by family
+    """
+
+    def __init__(self, points, prefix):
+        families = collections.OrderedDict()
+        for index, point in enumerate(points):
+            name = _metric_name(prefix, point.cls, point.name)
+            if point.flag == 'a':
+                type_, sample = 'counter', name + '_total'
+
+            else:
+                type_, sample = 'gauge', name
+
+            if point.ident:
+                label = _IDENT_LABELS.get(point.cls, 'ident')
+                sample = '%s{%s="%s"}' % (sample, label,
+                                          _escape_label(point.ident))
+
+            if name not in families:
+                families[name] = ("# TYPE %s %s\n# HELP %s %s\n" %
+                                  (name, type_, name,
+                                   _escape_help(point.desc)), [])
+
+            families[name][1].append((index, sample + ' '))
+
+        self.families = families.values()
+
+    def render(self, values):
+        lines = []
+        for header, samples in self.families:
+            lines.append(header)
+            for index, sample in samples:
+                lines.append("%s%s\n" % (sample, values[index]))
+
+        lines.append("# EOF\n")
+        return ''.join(lines)
+
+
+# templates by schema, then prefix: schemas are only referenced weakly, so
+# that templates go away with the layouts they were built for
+_templates = weakref.WeakKeyDictionary()
+
+
+def render(reading, prefix='varnish'):
+    """ Render a VarnishStatsReading or VarnishStatsArrayReading in the
+        OpenMetrics text format: accumulating counters are exposed as
+        counters, the others as gauges, and counters idents are exposed as
+        labels (i.e. `backend` for VBE counters)
+    """
+    if isinstance(reading, VarnishStatsArrayReading):
+        templates = _templates.get(reading.schema)
+        if templates is None:
+            templates = _templates[reading.schema] = {}
+
+        template = templates.get(prefix)
+        if template is None:
+            template = templates[prefix] = _Template(reading.schema.points,
+                                                     prefix)
+
+        return template.render(reading.values)
+
+    points = reading.values()
+    return _Template(points, prefix).render([p.value for p in points])
+
+
+class ExpositionCache(object):
+    """ Renders readings returned by `source`, a callable (i.e.
+        instance.stats.view().snapshot), at most once every `interval`
+        seconds, sharing the result among all the callers of payload().
+        It is thread safe: concurrent callers wait for a single read and
+        render.
+    """
+
+    def __init__(self, source, interval=1, prefix='varnish'):
+        self.source = source
+        self.interval = interval
+        self.prefix = prefix
+        self.renders = 0
+        self._payload = None
+        self._rendered_at = None
+        self._lock = threading.Lock()
+
+    def payload(self):
+        """ Return the rendered exposition, rendering it again if it is
+            older than interval """
+        with self._lock:
+            now = time.time()
+            if self._payload is None or \
+               now - self._rendered_at >= self.interval:
+                self._payload = render(self.source(), self.prefix)
+                self._rendered_at = now
+                self.renders += 1
+
+            return self._payload
+
+    def __str__(self):
+        return "<%s [interval: %s, renders: %s]>" % (self.__class__.__name__,
+                                                     self.interval,
+                                                     self.renders)
+
+    def __repr__(self):
+        return str(self)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        try:
+            payload = self.server.cache.payload()
+
+        except Exception as e:
+            log.exception("Cannot render metrics")
+            self.send_error(500, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s", self.address_string(), format % args)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    """ Threaded HTTP server exposing the payload of an ExpositionCache on
+        /metrics, listening on `address` (a (host, port) tuple)
+    """
+
+    def __init__(self, cache, address=('', 9131)):
+        self.cache = cache
+        self.httpd = _ThreadingHTTPServer(address, _MetricsHandler)
+        self.httpd.cache = cache
+        self.address = self.httpd.server_address
+        self._thread = None
+
+    def start(self):
+        """ Serve requests in a background thread """
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __str__(self):
+        return "<%s [%s:%s]>" % ((self.__class__.__name__,) + self.address)
+
+    def __repr__(self):
+        return str(self)
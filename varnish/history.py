@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+from array import array
+import calendar
+import itertools
+import operator
+from .stats import _columns
+
+__all__ = ['StatsHistory']
+
+
+class _Rollup(object):
+    """ Circular arrays of min, max and sum of the samples of every counter
+        in `slots` periods of `period` seconds
+    """
+
+    def __init__(self, period, slots, size):
+        self.period = period
+        self.slots = slots
+        self.size = size
+        self.min = array('d', [0.0]) * (slots * size)
+        self.max = array('d', [0.0]) * (slots * size)
+        self.sum = array('d', [0.0]) * (slots * size)
+        self.counts = array('l', [0]) * slots
+        self.ends = array('d', [0.0]) * slots
+        self.committed = 0
+        self.bucket = None
+        self._reset()
+
+    def _reset(self):
+        self.cur_min = None
+        self.cur_max = None
+        self.cur_sum = None
+        self.cur_count = 0
+
+    def add(self, timestamp, samples):
+        bucket = int(timestamp // self.period)
+        if self.bucket is not None and bucket != self.bucket:
+            self.commit()
+
+        self.bucket = bucket
+        if self.cur_count:
+            self.cur_min = map(min, self.cur_min, samples)
+            self.cur_max = map(max, self.cur_max, samples)
+            self.cur_sum = map(operator.add, self.cur_sum, samples)
+
+        else:
+            self.cur_min = samples
+            self.cur_max = samples
+            self.cur_sum = samples
+
+        self.cur_count += 1
+
+    def commit(self):
+        if not self.cur_count:
+            return
+
+        slot = self.committed % self.slots
+        start = slot * self.size
+        end = start + self.size
+        self.min[start:end] = array('d', self.cur_min)
+        self.max[start:end] = array('d', self.cur_max)
+        self.sum[start:end] = array('d', self.cur_sum)
+        self.counts[slot] = self.cur_count
+        self.ends[slot] = (self.bucket + 1) * self.period
+        self.committed += 1
+        self._reset()
+
+    def buckets(self, since=None):
+        """ Yield the slots of the committed buckets ending after `since`,
+            oldest first """
+        first = max(0, self.committed - self.slots)
+        for k in xrange(first, self.committed):
+            slot = k % self.slots
+            if since is None or self.ends[slot] > since:
+                yield slot
+
+
+class StatsHistory(object):
+    """ Fixed memory history of counters.
+        The last `size` readings added are kept as they are, and samples
+        are also aggregated in rollups: `rollups` is a list of
+        (period, slots) tuples, each keeping minimum, maximum and average of
+        `slots` periods of `period` seconds. Samples are per second rates
+        for accumulating counters and values for gauges.
+        All the memory is allocated when the first reading is added, in
+        circular arrays. Adding readings with different counters clears the
+        history.
+    """
+
+    def __init__(self, size=600, rollups=((60, 60), (300, 288))):
+        self.size = size
+        self.rollup_specs = tuple(rollups)
+        self.clear()
+
+    def clear(self):
+        """ Discard all the history """
+        self.names = None
+        self.index = None
+        self.flags = None
+        self.rollups = ()
+        self._count = 0
+        self._values = None
+        self._timestamps = None
+        self._gauges = ()
+
+    def add(self, reading):
+        """ Add a VarnishStatsReading or VarnishStatsArrayReading """
+        names, flags, values = _columns(reading)
+        timestamp = calendar.timegm(reading.timestamp.utctimetuple()) + \
+                    reading.timestamp.microsecond / 1e6
+        if names is not self.names and names != self.names:
+            self._setup(names, flags)
+
+        n = len(names)
+        values = array('d', values)
+        if self._count:
+            last = self._slot(self._count - 1)
+            interval = timestamp - self._timestamps[last]
+            if interval <= 0:
+                return
+
+            previous = self._values[last * n:(last + 1) * n]
+            deltas = map(operator.sub, values, previous)
+            samples = list(itertools.imap(operator.mul, deltas,
+                                          itertools.repeat(1.0 / interval)))
+            if deltas and min(deltas) < 0:
+                # counters reset, i.e. varnish restarted
+                for i, delta in enumerate(deltas):
+                    if delta < 0:
+                        samples[i] = values[i] / interval
+
+            for i in self._gauges:
+                samples[i] = values[i]
+
+            for rollup in self.rollups:
+                rollup.add(timestamp, samples)
+
+        slot = self._slot(self._count)
+        self._values[slot * n:(slot + 1) * n] = values
+        self._timestamps[slot] = timestamp
+        self._count += 1
+
+    def _setup(self, names, flags):
+        self.clear()
+        n = len(names)
+        self.names = names
+        self.flags = flags
+        self.index = dict((name, i) for i, name in enumerate(names))
+        self._gauges = tuple(i for i, f in enumerate(flags) if f != 'a')
+        self._values = array('d', [0.0]) * (self.size * n)
+        self._timestamps = array('d', [0.0]) * self.size
+        self.rollups = tuple(_Rollup(period, slots, n)
+                             for period, slots in self.rollup_specs)
+
+    def _slot(self, k):
+        return k % self.size
+
+    def _find(self, timestamp):
+        """ Return the index of the oldest reading taken at or after
+            timestamp """
+        low = max(0, self._count - self.size)
+        high = self._count - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamps[self._slot(middle)] < timestamp:
+                low = middle + 1
+
+            else:
+                high = middle
+
+        return low
+
+    def _check(self, name):
+        if self.index is None or name not in self.index:
+            raise KeyError(name)
+
+        return self.index[name]
+
+    def samples(self, name, seconds=None):
+        """ Return the (timestamp, value) readings of a counter in the last
+            `seconds` seconds (all of those kept if None) """
+        i = self._check(name)
+        n = len(self.names)
+        last = self._timestamps[self._slot(self._count - 1)]
+        if seconds is None:
+            first = max(0, self._count - self.size)
+
+        else:
+            first = self._find(last - seconds)
+
+        result = []
+        for k in xrange(first, self._count):
+            slot = self._slot(k)
+            result.append((self._timestamps[slot],
+                           self._values[slot * n + i]))
+
+        return result
+
+    def rate(self, name, seconds):
+        """ Return the per second rate of an accumulating counter over the
+            last `seconds` seconds. When the readings kept do not cover the
+            interval, the finest rollup spanning it is used.
+            Returns None if there is not enough history, or no rollup spans
+            the interval.
+        """
+        i = self._check(name)
+        if self.flags[i] != 'a':
+            raise ValueError("%s is not an accumulating counter" % (name))
+
+        if self._count < 2:
+            return None
+
+        n = len(self.names)
+        last = self._slot(self._count - 1)
+        now = self._timestamps[last]
+        first = self._slot(max(0, self._count - self.size))
+        if now - self._timestamps[first] >= seconds:
+            start = self._slot(self._find(now - seconds))
+            delta = self._values[last * n + i] - self._values[start * n + i]
+            interval = now - self._timestamps[start]
+            if delta >= 0 and interval > 0:
+                return delta / interval
+
+        rollups = [r for r in self.rollups if r.period * r.slots >= seconds]
+        if not rollups:
+            return None
+
+        rollup = min(rollups, key=lambda r: r.period)
+        return self._rollup_average(rollup, i, now - seconds)
+
+    def _rollup_average(self, rollup, i, since):
+        slots = list(rollup.buckets(since))
+        if not slots:
+            return None
+
+        total = sum(rollup.sum[slot * rollup.size + i] for slot in slots)
+        count = sum(rollup.counts[slot] for slot in slots)
+        return total / count
+
+    def rollup(self, name, period):
+        """ Return the (end timestamp, min, max, average) samples of a
+            counter aggregated every `period` seconds, oldest first """
+        i = self._check(name)
+        for rollup in self.rollups:
+            if rollup.period == period:
+                break
+
+        else:
+            raise KeyError("No rollup every %s seconds" % (period))
+
+        result = []
+        for slot in rollup.buckets():
+            pos = slot * rollup.size + i
+            result.append((rollup.ends[slot], rollup.min[pos],
+                           rollup.max[pos],
+                           rollup.sum[pos] / rollup.counts[slot]))
+
+        return result
+
+    def __len__(self):
+        return min(self._count, self.size)
+
+    def __str__(self):
+        return "<%s [%s readings, %s counters]>" % (
+                    self.__class__.__name__, len(self),
+                    len(self.names) if self.names else 0)
+
+    def __repr__(self):
+        return str(self)
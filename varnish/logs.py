@@ -22,13 +22,37 @@ LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
 OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
+import collections
 from datetime import datetime
 import inspect
+import time
 import logging
 import functools
-from .api import logs
-from .utils import MultiDict
+from . import aio
+from . import vsl
+from .utils import MultiDict, cached_property
+try:
+    from .api import logs
+
+except OSError:
+    # libvarnishapi is not available: requests can still be assembled from
+    # capture files, using the static tags table
+    logs = None
+
 log = logging.getLogger(__name__)
+_tags = logs.LogTags() if logs is not None else vsl.TAGS
+_SLT_REQSTART = _tags['reqstart'].code
+_SLT_REQEND = _tags['reqend'].code
+_SLT_BACKENDOPEN = _tags['backendopen'].code
+_SLT_BACKENDREUSE = _tags['backendreuse'].code
+_SLT_BACKENDCLOSE = _tags['backendclose'].code
+# vcl_calls of client requests sent to a backend
+_BACKEND_CALLS = ('miss', 'pass', 'pipe')
+# settings hiding records, possibly those opening connections that client
+# and backend flags are computed from
+_FILTERS = frozenset(['include_tag', 'include_tag_regex', 'exclude_tag',
+                      'exclude_tag_regex', 'skip_first',
+                      'filter_transactions_by_tag_regex'])
 
 
 class VarnishLogs(object):
@@ -52,6 +76,8 @@ class VarnishLogs(object):
         self.settings.update(settings)
         self.varnish = varnish
         self.vd = varnish.vd
+        self._filtered = any(self.settings[st] for st in _FILTERS)
+        self._from_file = bool(self.settings['read_entries_from_file'])
         logs.init(self.vd, True)
         for st, value in self.settings.items():
             if value and self.default_settings[st] is None:
@@ -65,121 +91,664 @@ class VarnishLogs(object):
 
     def __getattr__(self, attr):
         if attr in self.default_settings:
+            if attr in _FILTERS:
+                self._filtered = True
+
+            elif attr == 'read_entries_from_file':
+                self._from_file = True
+
             return functools.partial(getattr(logs, attr), self.vd)
 
         raise AttributeError(attr)
 
-    def dispatch_chunks(self, callback, source=None):
+    def iter_chunks(self, source=None):
+        """ Read logs from varnish shared memory logs, yielding every chunk
+            as returned from the low level api (instances of the
+            varnish.api.logs.LogChunk class).
+            Records are pulled from libvarnishapi, so reading can be stopped
+            at any time just by closing the generator. When filters are set,
+            records are read with VSL_Dispatch to get client and backend
+            flags right (see varnish.api.logs.iterate).
+        """
+        if source:
+            self.read_entries_from_file(source)
+
+        return logs.iterate(self.vd, dispatch=self._filtered)
+
+    def dispatch_chunks(self, callback, source=None, monitor=None):
         """ Read logs from varnish shared memory logs, then call callback
             for every chunk as returned from the low level api
             `callback` must be a callable that accepts 0 or 1 positional
-            parameter (an instance of the varnish.api.logs.LogChunk class)
+            parameter (an instance of the varnish.api.logs.LogChunk class).
+            Reading stops if callback returns False.
+            `monitor` (optional) is a LogMonitor every chunk is added to.
         """
         if callback:
             args = len(inspect.getargspec(callback).args)
 
-        def wrapper(chunk, priv):
-            res = False
+        chunks = self.iter_chunks(source)
+        if monitor is not None:
+            self._setup_monitor(monitor)
 
-            if callback and args == 0:
-                res = callback()
+        try:
+            for chunk in chunks:
+                if monitor is not None:
+                    monitor.add(chunk)
 
-            elif callback:
-                res = callback(chunk)
+                res = None
+                if callback and args == 0:
+                    res = callback()
 
-            return res
+                elif callback:
+                    res = callback(chunk)
+
+                if res is False:
+                    break
+
+        finally:
+            chunks.close()
 
+    def dispatch_batches(self, callback, batch_size=1000, max_latency=None,
+                         source=None):
+        """ Read logs from varnish shared memory logs, then call callback
+            with a list of chunks (instances of the
+            varnish.api.logs.LogChunk class) every `batch_size` chunks read.
+            If `max_latency` is set, a non empty batch is delivered no later
+            than `max_latency` seconds after its first chunk was read, as
+            long as chunks keep coming or libvarnishapi stops waiting for
+            new ones (which happens every few seconds on idle instances).
+            The last, possibly incomplete, batch is delivered before
+            returning. Reading stops if callback returns False.
+        """
         if source:
             self.read_entries_from_file(source)
 
-        logs.dispatch(self.vd, wrapper)
+        batch = []
+        started = None
+        chunks = logs.iterate(self.vd, idle=max_latency is not None,
+                              dispatch=self._filtered)
+        try:
+            for chunk in chunks:
+                if chunk is not None:
+                    if not batch and max_latency is not None:
+                        started = time.time()
+
+                    batch.append(chunk)
+                    if len(batch) < batch_size and \
+                       (max_latency is None or
+                        time.time() - started < max_latency):
+                        continue
+
+                elif not batch or time.time() - started < max_latency:
+                    continue
+
+                res = callback(batch)
+                batch = []
+                if res is False:
+                    return
+
+            if batch:
+                callback(batch)
+
+        finally:
+            chunks.close()
 
     def dispatch_requests(self, callback, aggregate=1000, source=None,
-                          nonrequest_callback=None):
+                          nonrequest_callback=None, assembler=None,
+                          fields=None, keep_chunks=True, monitor=None):
         """ Read logs from Varnish shared memory Logs, then call callback
             when a RequestLog is complete (all its chunks have been read).
             `callback` must be a callable that accepts 1 positional parameter
             (an instance of ClientRequestLog or BackendRequestLog, subclasses
              of RequestLog)
             if `aggregate` is true, try to relate backend requests to the
-            client request that generated it
+            client request that generated it, keeping at most `aggregate`
+            backend requests waiting for their client request. `aggregate`
+            can also be a CorrelationTable instance, to limit the time
+            backend requests are kept or to read its counters.
             `nonrequest_callback` (optional), if set, must be a callable that
             accepts 1 positional parameter (an instance of
             varnish.api.logs.LogChunk) which will be invoked for log lines not
             related to any individual request.
+            `assembler` (optional) is the RequestLogAssembler used to keep
+            track of incomplete requests: pass one to tune its limits or to
+            read its counters. A new one with default limits is used
+            otherwise.
+            `fields` and `keep_chunks` (optional) are passed to the
+            RequestLogAssembler to skip the work needed to fill attributes
+            nobody reads, see RequestLogAssembler for details. They are
+            ignored if `assembler` is given.
+            `monitor` (optional) is a LogMonitor every chunk is added to,
+            to detect lost records and measure how far behind varnish the
+            reader is.
         """
-        if aggregate:
-            # use a multidict because it is ordered
-            backend_requests = MultiDict()
+        if source:
+            self.read_entries_from_file(source)
 
-        def cb(chunk):
-            if chunk.fd == 0 and nonrequest_callback:
-                return nonrequest_callback(chunk)
+        if monitor is not None:
+            self._setup_monitor(monitor)
 
-            ev = RequestLog(chunk)
-            # discard invalid, incomplete and empty logs
-            res = True
-            if not ev or not ev.complete or (ev.backend and not ev.chunks):
-                return res
+        cb = request_dispatcher(callback, aggregate, nonrequest_callback,
+                                assembler, fields, keep_chunks, monitor)
+        self.dispatch_chunks(callback=cb)
 
-            if not aggregate:
-                res = callback(ev)
+    def _setup_monitor(self, monitor):
+        """ Turn off the LogMonitor measures meaningless for the records
+            read: XID gaps when filters hide requests, lag when reading
+            from a file """
+        if self._filtered:
+            monitor.xid_window = None
 
-            elif ev.backend:
-                id_ = ev.txheaders.getone('x-varnish')
-                log.debug("Adding %s to backend_requests", ev)
-                backend_requests.overwrite(id_, ev)
+        if self._from_file:
+            monitor.live = False
 
-            elif ev.client and ev.id in backend_requests:
-                ev.backend_request = backend_requests.getone(ev.id)
-                res = callback(ev)
+    def requests(self, maxsize=1000, loop=None, executor=None, **kwargs):
+        """ Return an AsyncStream of the RequestLog objects read by
+            dispatch_requests(), called with `kwargs` in an executor, i.e.
+            with trollius `request = yield From(stream.get())`.
+            See varnish.aio.AsyncStream
+        """
+        return aio.requests(self, maxsize, loop, executor, **kwargs)
 
-            else:
-                # backend request was not read, leaving to None
-                res = callback(ev)
+    def __str__(self):
+        return "<%s [instance: %s]>" % (self.__class__.__name__,
+                                        self.varnish.name)
+
+    def __repr__(self):
+        return str(self)
 
-            if aggregate and len(backend_requests) > aggregate:
-                backend_requests.trim(aggregate)
 
+def request_dispatcher(callback, aggregate=1000, nonrequest_callback=None,
+                       assembler=None, fields=None, keep_chunks=True,
+                       monitor=None):
+    """ Return a callable that accepts LogChunk objects one at a time and
+        calls `callback` with complete RequestLog objects, as
+        VarnishLogs.dispatch_requests() does (see it for the parameters).
+        It returns False when `callback` does, to stop reading.
+    """
+    if assembler is None:
+        # an empty CorrelationTable is false
+        if fields is not None and \
+           (aggregate or isinstance(aggregate, CorrelationTable)):
+            # needed to relate backend and client requests
+            fields = list(fields) + ['id', 'vcl_calls',
+                                     'txheaders.x-varnish']
+
+        assembler = RequestLogAssembler(fields=fields,
+                                        keep_chunks=keep_chunks)
+
+    backend_requests = None
+    if isinstance(aggregate, CorrelationTable):
+        backend_requests = aggregate
+
+    elif aggregate:
+        backend_requests = CorrelationTable(max_size=aggregate)
+
+    if monitor is not None and monitor.assembler is None:
+        monitor.assembler = assembler
+
+    def cb(chunk):
+        if monitor is not None:
+            monitor.add(chunk)
+
+        if chunk.fd == 0 and nonrequest_callback:
+            return nonrequest_callback(chunk)
+
+        ev = assembler.add(chunk)
+        # discard invalid and incomplete logs
+        res = True
+        if not ev or not ev.complete:
             return res
 
-        self.dispatch_chunks(callback=cb, source=source)
+        if backend_requests is None:
+            res = callback(ev)
+
+        elif ev.backend:
+            id_ = ev.txheaders.getone('x-varnish')
+            log.debug("Adding %s to backend_requests", ev)
+            backend_requests.add(id_, ev)
+
+        else:
+            # only misses, passes and pipes have a backend request: if it
+            # was not read, leave it to None
+            if any(call in ev.vcl_calls for call in _BACKEND_CALLS):
+                ev.backend_request = backend_requests.pop(ev.id)
+
+            res = callback(ev)
+
+        return res
+
+    return cb
+
+
+class RequestLogAssembler(object):
+    """ Aggregates chunks into RequestLog objects, keeping track of the
+        requests which are still being read.
+        At most `max_pending` incomplete requests are kept (None means no
+        limit), and if `max_age` is set requests not completed within
+        `max_age` seconds are discarded too; the oldest ones are discarded
+        first. Discarded requests are counted in `evicted` and passed to
+        `evict_callback`, if set.
+        If `fields` is set, only those RequestLog attributes are filled in
+        and chunks not needed for them are skipped. Single headers can be
+        selected as `rxheaders.<name>` or `txheaders.<name>`. If
+        `keep_chunks` is false, chunks are not kept in RequestLog.chunks.
+    """
+
+    def __init__(self, max_pending=10000, max_age=None, evict_callback=None,
+                 fields=None, keep_chunks=True):
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.evict_callback = evict_callback
+        self.evicted = 0
+        self.fields = fields
+        self.keep_chunks = keep_chunks
+        self._lines = collections.OrderedDict()
+        self._settings = {}
+        if fields is not None:
+            for cls in (ClientRequestLog, BackendRequestLog):
+                self._settings[cls] = cls.projection(fields)
+
+        if not keep_chunks:
+            for cls in (ClientRequestLog, BackendRequestLog):
+                self._settings.setdefault(cls, {})['_keep_chunks'] = False
+
+    def add(self, chunk):
+        """ Add chunk to the request it belongs to and return that request.
+            Returns None if the chunk belongs to no request.
+        """
+        fd = chunk.fd
+        if fd == 0:
+            return None
+
+        obj = self._lines.get(fd)
+        code = chunk.tag.code
+        if (code == _SLT_REQSTART and chunk.client) or \
+           (code == _SLT_BACKENDOPEN and chunk.backend):
+            if obj is not None:
+                # the end of the previous request on this fd was lost
+                self._evict(fd)
+
+            obj = self._start(chunk)
+
+        elif obj is None:
+            return None
+
+        if obj.add_chunk(chunk):
+            del self._lines[fd]
+            if code == _SLT_BACKENDREUSE:
+                # backend reuse need a special case to get the next backend
+                # request as no backendopen will arrive
+                self._start(chunk).on_append_chunk(chunk)
+
+        return obj
+
+    def _start(self, chunk):
+        lines = self._lines
+        now = time.time()
+        if self.max_age is not None:
+            while lines and \
+                  now - lines[next(iter(lines))].started > self.max_age:
+                self._evict(next(iter(lines)))
+
+        if self.max_pending is not None:
+            while lines and len(lines) >= self.max_pending:
+                self._evict(next(iter(lines)))
+
+        if chunk.client:
+            obj = object.__new__(ClientRequestLog)
+
+        else:
+            obj = object.__new__(BackendRequestLog)
+
+        settings = self._settings.get(obj.__class__)
+        if settings:
+            obj.__dict__.update(settings)
+
+        obj.init(chunk, active=True)
+        obj.started = now
+        lines[chunk.fd] = obj
+        return obj
+
+    def _evict(self, fd):
+        obj = self._lines.pop(fd)
+        self.evicted += 1
+        log.debug("Discarding incomplete request %s", obj)
+        if self.evict_callback:
+            self.evict_callback(obj)
+
+    def clear(self):
+        """ Discard all incomplete requests, without counting them as
+            evicted """
+        self._lines.clear()
+
+    def __len__(self):
+        return len(self._lines)
 
     def __str__(self):
-        return "<%s [instance: %s]>" % (self.__class__.__name__,
-                                        self.varnish.name)
+        return "<%s [pending: %s, evicted: %s]>" % (self.__class__.__name__,
+                                                    len(self), self.evicted)
 
     def __repr__(self):
         return str(self)
 
 
+class CorrelationTable(object):
+    """ Keeps backend requests until the client request they belong to is
+        read. At most `max_size` of them are kept (None means no limit), and
+        if `max_age` is set backend requests older than `max_age` seconds
+        are discarded too; the oldest ones are discarded first.
+        `hits` and `misses` count lookups which did and did not find a
+        backend request, `evicted` counts backend requests discarded
+        without being looked up. Requests are only looked up for client
+        requests that went to a backend (miss, pass or pipe).
+    """
+
+    def __init__(self, max_size=1000, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._entries = collections.OrderedDict()
+
+    def add(self, key, value):
+        """ Add value for key, replacing the previous value if any """
+        entries = self._entries
+        now = time.time()
+        if entries.pop(key, None) is not None:
+            self.evicted += 1
+
+        if self.max_age is not None:
+            while entries and \
+                  now - entries[next(iter(entries))][0] > self.max_age:
+                entries.popitem(last=False)
+                self.evicted += 1
+
+        while entries and self.max_size is not None and \
+              len(entries) >= self.max_size:
+            entries.popitem(last=False)
+            self.evicted += 1
+
+        entries[key] = (now, value)
+
+    def pop(self, key, default=None):
+        """ Remove and return the value for key, or default if missing """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "<%s [size: %s, hits: %s, misses: %s, evicted: %s]>" % \
+                (self.__class__.__name__, len(self), self.hits, self.misses,
+                 self.evicted)
+
+    def __repr__(self):
+        return str(self)
+
+
+class LogMonitor(object):
+    """ Watches the chunks read from the logs for signs that varnish
+        overwrote records before they were read.
+        Client requests are numbered (XID) by varnish in order: XIDs never
+        read in ReqEnd records within `xid_window` XIDs after a newer one are
+        counted in `transactions_lost`, and the runs of them in `gaps`;
+        requests complete out of order, so the window must be larger than
+        the number of requests running at the same time.
+        `lag` is the number of seconds between the completion of the last
+        request read and the moment it was read. When it gets bigger than
+        `max_lag`, `lagging` is set and `callback` is called with the
+        monitor, so that the consumer can shed load; it is called again
+        when lag gets back under half of max_lag.
+        `assembler` is the RequestLogAssembler whose evictions (incomplete
+        requests discarded) are reported; dispatch_requests() sets it.
+        If `ring` is a varnish.api.ring.LogRing, its exact overrun and lap
+        counters are used.
+        Readers turn off what is meaningless for the records they read:
+        XIDs are not tracked if `xid_window` is None (filters hide
+        requests) and lag is not measured if `live` is false (reading a
+        file).
+    """
+
+    def __init__(self, max_lag=None, callback=None, xid_window=10000,
+                 assembler=None, ring=None, live=True):
+        self.max_lag = max_lag
+        self.callback = callback
+        self.xid_window = xid_window
+        self.assembler = assembler
+        self.ring = ring
+        self.live = live
+        self.records = 0
+        self.transactions = 0
+        self.transactions_lost = 0
+        self.gaps = 0
+        self.lag = None
+        self.lagging = False
+        self._max_xid = None
+        self._missing = set()
+        self._ranges = collections.deque()
+
+    def add(self, chunk):
+        """ Account for a LogChunk """
+        self.add_record(chunk.tag.code, chunk.data)
+
+    def add_record(self, tag, data):
+        """ Account for a record, given its tag code and data """
+        self.records += 1
+        if tag != _SLT_REQEND:
+            return
+
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        xid, started, completed = data.split(" ", 3)[:3]
+        self.transactions += 1
+        if self.xid_window is not None:
+            self._add_xid(int(xid))
+
+        if not self.live:
+            return
+
+        self.lag = time.time() - float(completed)
+        if self.max_lag is None:
+            return
+
+        if not self.lagging and self.lag > self.max_lag:
+            self.lagging = True
+            log.debug("Log reader lagging %.3fs behind", self.lag)
+            if self.callback:
+                self.callback(self)
+
+        elif self.lagging and self.lag < self.max_lag / 2.0:
+            self.lagging = False
+            log.debug("Log reader caught up (lag %.3fs)", self.lag)
+            if self.callback:
+                self.callback(self)
+
+    def _add_xid(self, xid):
+        last = self._max_xid
+        window = self.xid_window
+        if last is None or abs(xid - last) > window * 10:
+            # first request read, or varnish restarted
+            self._max_xid = xid
+            self._missing.clear()
+            self._ranges.clear()
+            return
+
+        if xid <= last:
+            if xid in self._missing:
+                self._missing.discard(xid)
+
+            elif xid <= last - window and self.transactions_lost:
+                # arrived after being counted as lost
+                self.transactions_lost -= 1
+
+            return
+
+        if xid > last + 1:
+            self._missing.update(xrange(last + 1, xid))
+            self._ranges.append((last + 1, xid))
+
+        self._max_xid = xid
+        ranges = self._ranges
+        while ranges and ranges[0][1] <= xid - window:
+            low, high = ranges.popleft()
+            lost = 0
+            for missing in xrange(low, high):
+                if missing in self._missing:
+                    self._missing.discard(missing)
+                    lost += 1
+
+            if lost:
+                self.gaps += 1
+                self.transactions_lost += lost
+
+    @property
+    def overruns(self):
+        """ Overruns of the ring if known, gaps in XIDs otherwise (None if
+            XIDs are not tracked) """
+        if self.ring is not None:
+            return self.ring.overruns
+
+        return self.gaps if self.xid_window is not None else None
+
+    @property
+    def records_lost(self):
+        """ Estimated number of records lost, None if unknown """
+        if self.ring is not None:
+            return self.ring.records_lost
+
+        if self.xid_window is None:
+            return None
+
+        if not self.transactions:
+            return 0
+
+        return self.transactions_lost * self.records // self.transactions
+
+    @property
+    def laps_behind(self):
+        """ Laps of the ring the reader is behind varnish, if known """
+        return self.ring.laps_behind if self.ring is not None else None
+
+    @property
+    def evicted(self):
+        """ Incomplete requests discarded by the assembler """
+        return self.assembler.evicted if self.assembler is not None else None
+
+    def __str__(self):
+        return "<%s [lag: %s, lost: %s, gaps: %s, evicted: %s]>" % (
+                    self.__class__.__name__, self.lag,
+                    self.transactions_lost, self.gaps, self.evicted)
+
+    def __repr__(self):
+        return str(self)
+
+
+def tag_handler(*names, **kwargs):
+    """ Decorator marking a RequestLog method as the handler for chunks
+        with the given tag names. Handlers are called with the chunk as the
+        only argument.
+        `fields` is the list of attributes set by the handler: when requests
+        are assembled only for some fields, handlers not setting any of them
+        are skipped. Handlers without fields are always called.
+    """
+    def decorator(method):
+        method.handled_tags = names
+        method.fields = kwargs.get('fields')
+        return method
+
+    return decorator
+
+
+def _with_tag_handlers(cls):
+    """ Class decorator that collects the tag handlers of a RequestLog class
+        (and of its bases) into the `_handlers` dict, keyed on tag code
+    """
+    handlers = {}
+    for klass in reversed(cls.__mro__):
+        for attr in vars(klass).itervalues():
+            for name in getattr(attr, 'handled_tags', ()):
+                handlers[_tags[name].code] = attr
+
+    cls._handlers = handlers
+    return cls
+
+
+def _header_names(fields, name):
+    """ Return the set of header names selected by fields as
+        `<name>.<header>`, or None if all headers are needed
+    """
+    if name in fields:
+        return None
+
+    prefix = name + "."
+    return frozenset(f[len(prefix):].lower() for f in fields
+                     if f.startswith(prefix))
+
+
+@_with_tag_handlers
 class RequestLog(object):
     """ This class is a factory for its subclasses. It keeps returning the
         same objects as long as the chunk belongs to an existing instance.
         It returns None if the chunk belongs to neither a client of backend
-        request
+        request.
+        Chunks are aggregated by a RequestLogAssembler shared by all
+        the instances created this way: readers should use their own
+        RequestLogAssembler instead.
     """
-    _lines = {}
+    _assembler = None
+    _end_tags = frozenset()
+    _keep_chunks = True
+    _rxheader_names = None
+    _txheader_names = None
 
     def __new__(cls, chunk, active=False):
-        if chunk.fd in cls._lines:
-            obj = cls._lines[chunk.fd]
-
-        else:
-            if chunk.client:
-                obj = super(RequestLog, cls).__new__(ClientRequestLog)
-
-            elif chunk.backend:
-                obj = super(RequestLog, cls).__new__(BackendRequestLog)
-
-            else:
-                return None
+        if RequestLog._assembler is None:
+            RequestLog._assembler = RequestLogAssembler(max_pending=None)
 
-            obj.init(chunk, active)
-            cls._lines[chunk.fd] = obj
+        return RequestLog._assembler.add(chunk)
 
-        obj.add_chunk(chunk)
-        return obj
+    @classmethod
+    def projection(cls, fields):
+        """ Return the instance settings needed to assemble only the given
+            fields (see RequestLogAssembler)
+        """
+        fields = set(fields)
+        known = set(['rxheaders', 'txheaders'])
+        for handler in cls.all_handlers():
+            known.update(handler.fields or ())
+
+        for field in fields:
+            if field.split(".", 1)[0] not in known:
+                raise ValueError("Unknown field %s" % (field))
+
+        wanted = set(f.split(".", 1)[0] for f in fields)
+        handlers = dict((code, h) for code, h in cls._handlers.iteritems()
+                        if h.fields is None or wanted.intersection(h.fields))
+        return {'_handlers': handlers,
+                '_rxheader_names': _header_names(fields, 'rxheaders'),
+                '_txheader_names': _header_names(fields, 'txheaders')}
+
+    @classmethod
+    def all_handlers(cls):
+        """ Return the tag handlers of all the RequestLog classes """
+        for klass in (cls, ClientRequestLog, BackendRequestLog):
+            for handler in klass._handlers.itervalues():
+                yield handler
 
     def init(self, chunk, active=False):
         if hasattr(self, "fd"):
@@ -200,32 +769,12 @@ class RequestLog(object):
         self.length = None
 
     def add_chunk(self, chunk):
-        if self.fd == 0:
+        if not self.active:
             return False
 
-        if not self.active and \
-            ((chunk.client and chunk.tag.name == 'reqstart') or
-             (chunk.backend and chunk.tag.name == 'backendopen')):
-            self.active = True
-
-        elif not self.active:
-            return False
-
-        if (chunk.client and chunk.tag.name == 'reqend') or \
-           (chunk.backend and (chunk.tag.name == 'backendclose' or
-                               chunk.tag.name == 'backendreuse')):
+        if chunk.tag.code in self._end_tags:
             self.complete = True
             self.active = False
-            del self.__class__._lines[self.fd]
-            if chunk.tag.name == 'backendreuse':
-                # backend reuse need a special case to get the next backend
-                # request as no backendopen will arrive
-                # then we create a new empry object that we now is active
-                next_backend = super(RequestLog, self.__class__)\
-                                        .__new__(BackendRequestLog)
-                next_backend.init(chunk, active=True)
-                self.__class__._lines[chunk.fd] = next_backend
-                next_backend.on_append_chunk(chunk)
 
         self.on_append_chunk(chunk)
         return self.complete
@@ -233,24 +782,38 @@ class RequestLog(object):
     def on_append_chunk(self, chunk):
         self.client = chunk.client
         self.backend = chunk.backend
-        self.chunks.append(chunk)
-        name = chunk.tag.name
-        if name == 'rxheader':
-            key, value = chunk.data.split(":", 1)
-            self.rxheaders[key.strip().lower()] = value.strip()
-
-        elif name == 'txheader':
-            key, value = chunk.data.split(":", 1)
-            self.txheaders[key.strip().lower()] = value.strip()
-
-        elif name == 'rxprotocol':
-            self.rxprotocol = chunk.data
-
-        elif name == 'txprotocol':
-            self.txprotocol = chunk.data
-
-        elif name == 'length':
-            self.length = int(chunk.data)
+        if self._keep_chunks:
+            self.chunks.append(chunk)
+
+        handler = self._handlers.get(chunk.tag.code)
+        if handler is not None:
+            handler(self, chunk)
+
+    @tag_handler('rxheader', fields=['rxheaders'])
+    def _on_rxheader(self, chunk):
+        key, value = chunk.data.split(":", 1)
+        key = key.strip().lower()
+        if self._rxheader_names is None or key in self._rxheader_names:
+            self.rxheaders[key] = value.strip()
+
+    @tag_handler('txheader', fields=['txheaders'])
+    def _on_txheader(self, chunk):
+        key, value = chunk.data.split(":", 1)
+        key = key.strip().lower()
+        if self._txheader_names is None or key in self._txheader_names:
+            self.txheaders[key] = value.strip()
+
+    @tag_handler('rxprotocol', fields=['rxprotocol'])
+    def _on_rxprotocol(self, chunk):
+        self.rxprotocol = chunk.data
+
+    @tag_handler('txprotocol', fields=['txprotocol'])
+    def _on_txprotocol(self, chunk):
+        self.txprotocol = chunk.data
+
+    @tag_handler('length', fields=['length'])
+    def _on_length(self, chunk):
+        self.length = int(chunk.data)
 
     def __repr__(self):
         res = "<%s %s" % (self.__class__.__name__, self.id)
@@ -260,8 +823,10 @@ class RequestLog(object):
         return res
 
 
+@_with_tag_handlers
 class ClientRequestLog(RequestLog):
     """ Aggragates chunks for a client request """
+    _end_tags = frozenset([_SLT_REQEND])
 
     def init(self, chunk, active=False):
         super(ClientRequestLog, self).init(chunk, active)
@@ -270,55 +835,78 @@ class ClientRequestLog(RequestLog):
         self.hash_data = []
         self.client_ip = None
         self.client_port = None
-        self.started_at = None
-        self.completed_at = None
+        self.started_ts = None
+        self.completed_ts = None
         self.req_start_delay = None
         self.processing_time = None
         self.deliver_time = None
         self.backend_request = None
 
-    def on_append_chunk(self, chunk):
-        super(ClientRequestLog, self).on_append_chunk(chunk)
-        name = chunk.tag.name
-
-        if name == 'vcl_call':
-            self._last_vcl = chunk.data
-
-        elif name == 'vcl_return':
-            self.vcl_calls[self._last_vcl] = chunk.data
-            del self._last_vcl
-
-        elif name == 'hash':
-            self.hash_data.append(chunk.data)
-
-        elif name == 'length':
-            self.length = int(chunk.data)
-
-        elif name == 'rxrequest':
-            self.method = chunk.data
-
-        elif name == 'rxurl':
-            self.url = chunk.data
-
-        elif name == 'reqstart':
-            self.client_ip, self.client_port, self.id = \
-                chunk.data.split(" ")
-
-        elif name == 'txstatus':
-            self.status = int(chunk.data)
-
-        elif name == 'txresponse':
-            self.response = chunk.data
-
-        elif name == 'reqend':
-            xid, started_at, completed_at, \
-                req_start_delay, processing_time, \
-                deliver_time = chunk.data.split(" ")
-            self.started_at = datetime.fromtimestamp(float(started_at))
-            self.completed_at = datetime.fromtimestamp(float(completed_at))
-            self.req_start_delay = float(req_start_delay)
-            self.processing_time = float(processing_time)
-            self.deliver_time = float(deliver_time)
+    @tag_handler('vcl_call', fields=['vcl_calls'])
+    def _on_vcl_call(self, chunk):
+        self._last_vcl = chunk.data
+
+    @tag_handler('vcl_return', fields=['vcl_calls'])
+    def _on_vcl_return(self, chunk):
+        self.vcl_calls[self._last_vcl] = chunk.data
+        del self._last_vcl
+
+    @tag_handler('hash', fields=['hash_data'])
+    def _on_hash(self, chunk):
+        self.hash_data.append(chunk.data)
+
+    @tag_handler('rxrequest', fields=['method'])
+    def _on_rxrequest(self, chunk):
+        self.method = chunk.data
+
+    @tag_handler('rxurl', fields=['url'])
+    def _on_rxurl(self, chunk):
+        self.url = chunk.data
+
+    @tag_handler('reqstart', fields=['id', 'client_ip', 'client_port'])
+    def _on_reqstart(self, chunk):
+        self.client_ip, self.client_port, self.id = chunk.data.split(" ")
+
+    @tag_handler('txstatus', fields=['status'])
+    def _on_txstatus(self, chunk):
+        self.status = int(chunk.data)
+
+    @tag_handler('txresponse', fields=['response'])
+    def _on_txresponse(self, chunk):
+        self.response = chunk.data
+
+    @tag_handler('reqend', fields=['started_at', 'completed_at',
+                                   'started_ts', 'completed_ts',
+                                   'req_start_delay', 'processing_time',
+                                   'deliver_time'])
+    def _on_reqend(self, chunk):
+        xid, started_ts, completed_ts, \
+            req_start_delay, processing_time, \
+            deliver_time = chunk.data.split(" ")
+        self.started_ts = float(started_ts)
+        self.completed_ts = float(completed_ts)
+        self.req_start_delay = float(req_start_delay)
+        self.processing_time = float(processing_time)
+        self.deliver_time = float(deliver_time)
+        # discard datetimes cached if read before ReqEnd (i.e. by repr())
+        self.__dict__.pop('started_at', None)
+        self.__dict__.pop('completed_at', None)
+
+    @cached_property
+    def started_at(self):
+        """ datetime of request start, built from started_ts """
+        if self.started_ts is None:
+            return None
+
+        return datetime.fromtimestamp(self.started_ts)
+
+    @cached_property
+    def completed_at(self):
+        """ datetime of request completion, built from completed_ts """
+        if self.completed_ts is None:
+            return None
+
+        return datetime.fromtimestamp(self.completed_ts)
 
     @property
     def hit(self):
@@ -355,30 +943,34 @@ class ClientRequestLog(RequestLog):
         return "<{self.__class__.__name__} XID: {self.id}>".format(self=self)
 
 
+@_with_tag_handlers
 class BackendRequestLog(RequestLog):
     """ Aggragates chunks for a backend request """
+    _end_tags = frozenset([_SLT_BACKENDCLOSE, _SLT_BACKENDREUSE])
 
     def init(self, chunk, active=False):
         super(BackendRequestLog, self).init(chunk, active)
         self.backend_name = None
 
-    def on_append_chunk(self, chunk):
-        super(BackendRequestLog, self).on_append_chunk(chunk)
-        name = chunk.tag.name
-        if name == 'txrequest':
-            self.method = chunk.data
+    @tag_handler('txrequest', fields=['method'])
+    def _on_txrequest(self, chunk):
+        self.method = chunk.data
 
-        elif name == 'txurl':
-            self.url = chunk.data
+    @tag_handler('txurl', fields=['url'])
+    def _on_txurl(self, chunk):
+        self.url = chunk.data
 
-        elif name == 'rxstatus':
-            self.status = int(chunk.data)
+    @tag_handler('rxstatus', fields=['status'])
+    def _on_rxstatus(self, chunk):
+        self.status = int(chunk.data)
 
-        elif name == 'rxresponse':
-            self.response = chunk.data
+    @tag_handler('rxresponse', fields=['response'])
+    def _on_rxresponse(self, chunk):
+        self.response = chunk.data
 
-        elif name in ('backendopen', 'backendreuse'):
-            self.backend_name = chunk.data.split(" ")[0]
+    @tag_handler('backendopen', 'backendreuse', fields=['backend_name'])
+    def _on_backendopen(self, chunk):
+        self.backend_name = chunk.data.split(" ")[0]
 
     def __repr__(self):
         return """
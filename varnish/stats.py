@@ -24,9 +24,28 @@ WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
 import collections
+import ctypes
 import datetime
 import inspect
-from .api import stats
+import itertools
+import operator
+import time
+from . import aio
+
+try:
+    from . import api
+    from .api import stats
+
+except OSError:
+    # libvarnishapi is not available: readings can still be built, i.e.
+    # from saved values
+    api = stats = None
+
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
 
 
 class VarnishStats(object):
@@ -34,6 +53,7 @@ class VarnishStats(object):
     def __init__(self, varnish):
         self.varnish = varnish
         self.vd = varnish.vd
+        self.descriptors = stats.VarnishStatsDescriptors(self.vd)
         stats.init(self.vd)
 
     def read(self, callback=None):
@@ -50,13 +70,72 @@ class VarnishStats(object):
                 callback(point)
 
         stats_list = list()
-        stats.iterate(self.vd, wrapper, stats_list)
+        stats.iterate(self.vd, wrapper, stats_list, self.descriptors)
         return VarnishStatsReading(stats_list)
 
+    def view(self):
+        """ Return the VarnishStatsView of this instance, used to read
+            counters values without walking all the counters every time
+        """
+        if not hasattr(self, "_view"):
+            self._view = VarnishStatsView(self)
+
+        return self._view
+
+    def changes(self, interval=1, count=None):
+        """ Generator that reads the counters every `interval` seconds
+            (`count` times, if set) and yields (full_name, old, new) tuples
+            for the counters whose value changed since the previous read.
+            `old` is None on the first read and for new counters.
+            Only raw values are compared, no VarnishStatsPoint is built.
+        """
+        view = self.view()
+        previous = None
+        previous_schema = None
+        deadline = time.time()
+        polls = 0
+        while True:
+            values = view.read()
+            schema = view.schema
+            if previous is not None and schema is previous_schema:
+                names = schema.names
+                changed = itertools.compress(xrange(len(values)),
+                                             map(operator.ne, values,
+                                                 previous))
+                for i in changed:
+                    yield (names[i], previous[i], values[i])
+
+            else:
+                index = previous_schema.index if previous is not None else {}
+                for i, name in enumerate(schema.names):
+                    old = previous[index[name]] if name in index else None
+                    if old != values[i]:
+                        yield (name, old, values[i])
+
+            previous = (ctypes.c_uint64 * len(values)).from_buffer_copy(values)
+            previous_schema = schema
+            polls += 1
+            if count is not None and polls >= count:
+                return
+
+            deadline += interval
+            time.sleep(max(0, deadline - time.time()))
+
+    def poll(self, interval=1, maxsize=1, loop=None, executor=None):
+        """ Return an AsyncStream of VarnishStatsArrayReading objects read
+            every `interval` seconds in an executor, i.e. with trollius
+            `reading = yield From(stream.get())`.
+            See varnish.aio.AsyncStream
+        """
+        return aio.poll(self, interval, maxsize, loop, executor)
+
     def filter(self, filter_, exclude=False):
         """ Set filters for next read() calls. Return self, so calls are
             chainable """
         stats.filter_(self.vd, filter_, exclude)
+        if hasattr(self, "_view"):
+            self._view.invalidate()
+
         return self
 
     def exclude(self, filter_):
@@ -79,15 +158,306 @@ class VarnishStats(object):
         return str(self)
 
 
+class VarnishStatsView(object):
+    """ Reads counters through a varnish.api.stats.VarnishStatsLayout,
+        which is rebuilt when varnish reallocates its shared memory or the
+        filters change.
+        read() returns an array with the values of the counters described by
+        `points`, in the same order. The same array is reused (and
+        overwritten) on every read, copy it to keep the values around.
+    """
+
+    def __init__(self, varnish_stats):
+        self.vd = varnish_stats.vd
+        self.descriptors = varnish_stats.descriptors
+        self.layout = None
+        self.schema = None
+        self.values = None
+
+    def invalidate(self):
+        """ Force the layout to be rebuilt on next read """
+        self.layout = None
+
+    def refresh(self):
+        """ Rebuild the layout if the shared memory changed.
+            Returns True if it was rebuilt.
+        """
+        reopened = api.reopen(self.vd)
+        if not reopened and self.layout is not None and \
+           self.layout.seq == api.seq(self.vd):
+            return False
+
+        if reopened:
+            self.descriptors.clear()
+
+        self.layout = stats.VarnishStatsLayout(self.vd, self.descriptors)
+        self.schema = VarnishStatsSchema(self.layout.points)
+        self.values = self.layout.values()
+        return True
+
+    @property
+    def points(self):
+        """ VarnishStatsPoint objects describing the counters, with the
+            values they had when the layout was built
+        """
+        self.refresh()
+        return self.layout.points
+
+    def read(self):
+        self.refresh()
+        return self.layout.read(self.values)
+
+    def snapshot(self):
+        """ Read the counters and return them as a
+            VarnishStatsArrayReading """
+        values = self.read()
+        return VarnishStatsArrayReading(self.schema, values)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __str__(self):
+        return "<%s [%s]>" % (self.__class__.__name__, self.layout)
+
+    def __repr__(self):
+        return str(self)
+
+
+class VarnishStatsSchema(object):
+    """ Immutable description of a list of counters, shared by all the
+        readings taken with the same layout: `points` are the
+        VarnishStatsPoint objects describing the counters, `descriptors`
+        their shared VarnishStatsDescriptor objects, `names` their full
+        names, `flags` their flags and `index` maps full names to positions.
+        `groups` indexes positions by class and ident, so that all the
+        counters of i.e. a backend are found without scanning them all.
+    """
+
+    def __init__(self, points):
+        object.__setattr__(self, "points", tuple(points))
+        object.__setattr__(self, "descriptors",
+                           tuple(p.descriptor for p in self.points))
+        object.__setattr__(self, "names",
+                           tuple(p.full_name for p in self.points))
+        object.__setattr__(self, "flags",
+                           tuple(p.flag for p in self.points))
+        object.__setattr__(self, "index",
+                           dict((n, i) for i, n in enumerate(self.names)))
+        object.__setattr__(self, "groups",
+                           _group((p, i) for i, p in
+                                  enumerate(self.points)))
+
+    def classes(self):
+        """ Return the classes of the counters, '' being the main one """
+        return self.groups.keys()
+
+    def idents(self, class_):
+        """ Return the idents of the counters of a class """
+        return self.groups[class_].keys()
+
+    def positions(self, class_, ident=''):
+        """ Return the positions of the counters of a class and ident """
+        return self.groups[class_][ident]
+
+    def by_ident(self, class_, ident=''):
+        """ Return the VarnishStatsPoint objects of the counters of a class
+            and ident """
+        return tuple(self.points[i] for i in self.groups[class_][ident])
+
+    def __len__(self):
+        return len(self.points)
+
+    def __str__(self):
+        return "<%s - %s counters>" % (self.__class__.__name__, len(self))
+
+    def __repr__(self):
+        return str(self)
+
+    def __setattr__(self, attr, value):
+        raise TypeError("'%s' object does not support "
+                        "attribute assignment" % (self.__class__.__name__))
+
+
+class VarnishStatsArrayReading(collections.Mapping):
+    """ Counters values read at the same time, stored in a contiguous uint64
+        array following the order of a VarnishStatsSchema.
+        Maps full names to values, which are also accessible as attributes.
+        Subtracting two readings with the same schema returns a
+        VarnishStatsDelta.
+    """
+
+    def __init__(self, schema, values, timestamp=None):
+        object.__setattr__(self, "timestamp",
+                           timestamp or datetime.datetime.utcnow())
+        object.__setattr__(self, "schema", schema)
+        object.__setattr__(self, "values",
+                           (ctypes.c_uint64 * len(values))
+                           .from_buffer_copy(values))
+
+    def point(self, key):
+        """ Return the VarnishStatsPoint describing the counter """
+        return self.schema.points[self.schema.index[key]]
+
+    def classes(self):
+        return self.schema.classes()
+
+    def idents(self, class_):
+        return self.schema.idents(class_)
+
+    def by_ident(self, class_, ident=''):
+        """ Return an OrderedDict mapping the names (without class and
+            ident) of the counters of a class and ident to their values,
+            i.e. by_ident('VBE', 'default(127.0.0.1,,80)') """
+        points = self.schema.points
+        values = self.values
+        return collections.OrderedDict(
+                    (points[i].name, values[i])
+                    for i in self.schema.positions(class_, ident))
+
+    def delta(self, other):
+        """ Return the VarnishStatsDelta between other, an older reading,
+            and this one """
+        if other.schema is not self.schema:
+            raise ValueError("Readings have different schemas")
+
+        if numpy is not None:
+            deltas = numpy.frombuffer(self.values, dtype=numpy.uint64)\
+                          .astype(numpy.int64) - \
+                     numpy.frombuffer(other.values, dtype=numpy.uint64)\
+                          .astype(numpy.int64)
+
+        else:
+            deltas = map(operator.sub, self.values, other.values)
+
+        interval = _seconds(self.timestamp - other.timestamp)
+        return VarnishStatsDelta(self.schema, deltas, interval, self)
+
+    __sub__ = delta
+
+    def __getitem__(self, key):
+        return self.values[self.schema.index[key]]
+
+    def __iter__(self):
+        return iter(self.schema.names)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.schema.index
+
+    def __str__(self):
+        return "<%s[%s] - %s elements>" % (self.__class__.__name__,
+                                           self.timestamp, len(self))
+
+    def __repr__(self):
+        return str(self)
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __setattr__(self, attr, value):
+        raise TypeError("'%s' object does not support "
+                        "attribute assignment" % (self.__class__.__name__))
+
+
+class VarnishStatsDelta(collections.Mapping):
+    """ Difference between two VarnishStatsArrayReading objects, taken
+        `interval` seconds apart. Maps full names to deltas, which are also
+        accessible as attributes. `values` is a numpy array when numpy is
+        available, a list otherwise.
+        `reading` is the newer of the two readings, if known.
+    """
+
+    def __init__(self, schema, values, interval, reading=None):
+        object.__setattr__(self, "schema", schema)
+        object.__setattr__(self, "values", values)
+        object.__setattr__(self, "interval", interval)
+        object.__setattr__(self, "reading", reading)
+
+    def rates(self):
+        """ Return the deltas divided by the interval, per second """
+        if not self.interval:
+            raise ZeroDivisionError("Readings were taken at the same time")
+
+        if numpy is not None:
+            return self.values / self.interval
+
+        interval = float(self.interval)
+        return [v / interval for v in self.values]
+
+    def rate(self, key):
+        return self[key] / float(self.interval)
+
+    def __getitem__(self, key):
+        return self.values[self.schema.index[key]]
+
+    def __iter__(self):
+        return iter(self.schema.names)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.schema.index
+
+    def __str__(self):
+        return "<%s[%ss] - %s elements>" % (self.__class__.__name__,
+                                            self.interval, len(self))
+
+    def __repr__(self):
+        return str(self)
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __setattr__(self, attr, value):
+        raise TypeError("'%s' object does not support "
+                        "attribute assignment" % (self.__class__.__name__))
+
+
 class VarnishStatsReading(collections.Mapping):
     def __init__(self, points):
         object.__setattr__(self, "timestamp", datetime.datetime.utcnow())
         object.__setattr__(self, "_points", {})
+        object.__setattr__(self, "_groups", None)
         for point in points:
             self._points[point.full_name] = point
 
+    @property
+    def groups(self):
+        """ Points indexed by class and ident, built on first access """
+        if self._groups is None:
+            object.__setattr__(self, "_groups",
+                               _group((p, p) for p in
+                                      self._points.itervalues()))
+
+        return self._groups
+
+    def classes(self):
+        return self.groups.keys()
+
+    def idents(self, class_):
+        return self.groups[class_].keys()
+
+    def by_ident(self, class_, ident=''):
+        """ Return an OrderedDict mapping the names (without class and
+            ident) of the counters of a class and ident to their
+            VarnishStatsPoint objects """
+        return collections.OrderedDict((p.name, p)
+                                       for p in self.groups[class_][ident])
+
     def iter_by_class(self, class_):
-        return (p for p in self.itervalues() if p.cls == class_)
+        return itertools.chain.from_iterable(
+                                self.groups.get(class_, {}).itervalues())
 
     def get_in_class(self, class_):
         return list(self.iter_by_class(class_))
@@ -124,3 +494,187 @@ class VarnishStatsReading(collections.Mapping):
     def __setattr__(self, attr, value):
         raise TypeError("'%s' object does not support "
                         "attribute assignment" % (self.__class__.__name__))
+
+
+class StatsSampler(object):
+    """ Turns successive readings (VarnishStatsReading or
+        VarnishStatsArrayReading objects) into StatsSample objects, holding
+        per second rates for accumulating counters (flag 'a') and current
+        values for gauges (flag 'i').
+        A counter lower than in the previous reading is considered reset
+        (i.e. varnish restarted): its rate is computed from zero and the
+        reset counted in `resets`.
+        `ratios` maps names of derived ratios to (numerator, denominators)
+        tuples of counters names: ratios are computed on the increments of
+        the counters in the interval. It defaults to `default_ratios`.
+    """
+    default_ratios = {
+        'cache_hit_ratio': ('cache_hit', ('cache_hit', 'cache_miss'))
+    }
+
+    def __init__(self, ratios=None):
+        if ratios is None:
+            ratios = self.default_ratios
+
+        self.ratios = dict(ratios)
+        self.resets = 0
+        self._previous = None
+
+    def add(self, reading):
+        """ Add a reading, returning the StatsSample for the interval since
+            the previous one, or None if this is the first reading
+        """
+        names, flags, values = _columns(reading)
+        previous = self._previous
+        self._previous = (reading.timestamp, names, values)
+        if previous is None:
+            return None
+
+        timestamp, previous_names, previous_values = previous
+        interval = _seconds(reading.timestamp - timestamp)
+        if interval <= 0:
+            return None
+
+        if previous_names is names or previous_names == names:
+            deltas = map(operator.sub, values, previous_values)
+
+        else:
+            previous_index = dict(zip(previous_names, previous_values))
+            deltas = [v - previous_index[n] if n in previous_index else None
+                      for n, v in zip(names, values)]
+
+        result = {}
+        increments = {}
+        resets = []
+        for name, flag, value, delta in zip(names, flags, values, deltas):
+            if flag != 'a':
+                result[name] = value
+                continue
+
+            if delta is None:
+                result[name] = None
+                continue
+
+            if delta < 0:
+                resets.append(name)
+                delta = value
+
+            increments[name] = delta
+            result[name] = delta / interval
+
+        self.resets += len(resets)
+        ratios = {}
+        for ratio, (numerator, denominators) in self.ratios.iteritems():
+            try:
+                total = sum(increments[d] for d in denominators)
+                ratios[ratio] = increments[numerator] / float(total) \
+                                if total else None
+
+            except KeyError:
+                ratios[ratio] = None
+
+        return StatsSample(reading.timestamp, interval, result, ratios,
+                           tuple(resets))
+
+    def samples(self, readings):
+        """ Generator yielding a StatsSample for every reading in
+            `readings` but the first """
+        for reading in readings:
+            sample = self.add(reading)
+            if sample is not None:
+                yield sample
+
+    def reset(self):
+        """ Forget the previous reading """
+        self._previous = None
+
+    def __str__(self):
+        return "<%s [resets: %s]>" % (self.__class__.__name__, self.resets)
+
+    def __repr__(self):
+        return str(self)
+
+
+class StatsSample(collections.Mapping):
+    """ Rates of counters and values of gauges over an `interval` (in
+        seconds) ending at `timestamp`, as computed by StatsSampler.
+        Derived ratios are in `ratios`, counters found reset in `resets`.
+        Values and ratios are accessible as attributes too.
+    """
+
+    def __init__(self, timestamp, interval, values, ratios, resets):
+        object.__setattr__(self, "timestamp", timestamp)
+        object.__setattr__(self, "interval", interval)
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "ratios", ratios)
+        object.__setattr__(self, "resets", resets)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __str__(self):
+        return "<%s[%s, %ss] - %s elements>" % (self.__class__.__name__,
+                                                self.timestamp,
+                                                self.interval, len(self))
+
+    def __repr__(self):
+        return "<%s[%s, %ss] - %s %s>" % (self.__class__.__name__,
+                                          self.timestamp, self.interval,
+                                          self._values, self.ratios)
+
+    def __getattr__(self, attr):
+        if attr in self._values:
+            return self._values[attr]
+
+        if attr in self.ratios:
+            return self.ratios[attr]
+
+        raise AttributeError(attr)
+
+    def __setattr__(self, attr, value):
+        raise TypeError("'%s' object does not support "
+                        "attribute assignment" % (self.__class__.__name__))
+
+
+def _group(items):
+    """ Index (point, item) pairs by point class and ident, returning an
+        OrderedDict of OrderedDicts of item tuples """
+    groups = collections.OrderedDict()
+    for point, item in items:
+        idents = groups.get(point.cls)
+        if idents is None:
+            idents = groups[point.cls] = collections.OrderedDict()
+
+        idents.setdefault(point.ident, []).append(item)
+
+    for idents in groups.itervalues():
+        for ident, items in idents.iteritems():
+            idents[ident] = tuple(items)
+
+    return groups
+
+
+def _seconds(delta):
+    """ Convert a timedelta to seconds """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _columns(reading):
+    """ Return names, flags and values of the counters in a reading """
+    if isinstance(reading, VarnishStatsArrayReading):
+        schema = reading.schema
+        return schema.names, schema.flags, reading.values
+
+    points = reading.values()
+    return (tuple(p.full_name for p in points),
+            tuple(p.flag for p in points),
+            [p.value for p in points])
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import ctypes
+import datetime
+from .. import vsl
+from ..stats import VarnishStatsSchema, VarnishStatsArrayReading
+
+
+class Point(object):
+    """ Stand-in for VarnishStatsPoint, describing a counter without
+        libvarnishapi """
+
+    def __init__(self, name, flag='a', cls='', ident='', desc=''):
+        self.cls = cls
+        self.ident = ident
+        self.name = name
+        self.flag = flag
+        self.desc = desc
+        self.descriptor = self
+        self.full_name = '.'.join(p for p in (cls, ident, name) if p)
+
+
+def reading(schema, values, seconds=0):
+    """ Return a VarnishStatsArrayReading of schema taken `seconds` seconds
+        after 2012-01-01 """
+    timestamp = datetime.datetime(2012, 1, 1) + \
+                datetime.timedelta(seconds=seconds)
+    return VarnishStatsArrayReading(
+                schema, (ctypes.c_uint64 * len(values))(*values), timestamp)
+
+
+def schema(*points):
+    return VarnishStatsSchema(points)
+
+
+def chunk(name, fd, data, spec=0):
+    """ Return the LogChunk of a record with tag `name` """
+    return vsl.LogChunk(vsl.LogChunk.tags[name].code, fd, len(data), spec,
+                        data, 0)
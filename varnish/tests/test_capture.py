@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import operator
+import os
+import shutil
+import tempfile
+import unittest
+from .. import vsl
+from ..capture import CaptureFile, CaptureWriter
+from ..logs import ClientRequestLog
+from . import chunk
+
+
+def session(fd, xid, url):
+    """ Return the chunks of a client session with a single request """
+    client = vsl.VSL_S_CLIENT
+    return [chunk('sessionopen', fd, '127.0.0.1 5000 :80', client),
+            chunk('reqstart', fd, '127.0.0.1 5000 %d' % xid, client),
+            chunk('rxrequest', fd, 'GET', client),
+            chunk('rxurl', fd, url, client),
+            chunk('vcl_call', fd, 'recv', client),
+            chunk('vcl_return', fd, 'lookup', client),
+            chunk('vcl_call', fd, 'hit', client),
+            chunk('vcl_return', fd, 'deliver', client),
+            chunk('txstatus', fd, '200', client),
+            chunk('reqend', fd, '%d 1349792323.200 1349792323.300 0.0 '
+                                '0.0 0.0' % xid, client),
+            chunk('sessionclose', fd, 'EOF', client)]
+
+
+def urls(requests):
+    return [r.url for r in requests]
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.chunks = [chunk('cli', 0, 'Rd ping')]
+        for i in xrange(50):
+            self.chunks.extend(session(12 + i % 3, 1000 + i, '/%d' % i))
+
+        self.chunks.append(chunk('backendopen', 14,
+                                 'default 127.0.0.1 6000 127.0.0.1 80',
+                                 vsl.VSL_S_BACKEND))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, **kwargs):
+        writer = CaptureWriter(os.path.join(self.dir, 'capture.log'),
+                               **kwargs)
+        with writer:
+            for c in self.chunks:
+                writer(c)
+
+        self.assertEqual(len(writer.files), 1)
+        return writer.files[0]
+
+    def assertChunks(self, chunks, expected):
+        self.assertEqual([(c.tag.name, c.fd, c.data, c.client, c.backend)
+                          for c in chunks],
+                         [(c.tag.name, c.fd, c.data, c.client, c.backend)
+                          for c in expected])
+
+    def test_round_trip(self):
+        with CaptureFile(self.write(batch_size=256)) as capture:
+            self.assertChunks(list(capture.iter_chunks()), self.chunks)
+
+    def test_tags(self):
+        path = self.write(tags=['RxURL'], nonrequest=False, backend=False)
+        with CaptureFile(path) as capture:
+            names = set(c.tag.name.lower() for c in capture.iter_chunks())
+
+        self.assertIn('rxurl', names)
+        self.assertIn('reqend', names)
+        self.assertNotIn('txstatus', names)
+        self.assertNotIn('cli', names)
+        self.assertNotIn('backendopen', names)
+
+    def test_requests(self):
+        with CaptureFile(self.write()) as capture:
+            requests = list(capture.iter_requests())
+
+        self.assertEqual(len(requests), 50)
+        self.assertTrue(all(isinstance(r, ClientRequestLog)
+                            for r in requests))
+        self.assertEqual([r.id for r in requests],
+                         [str(1000 + i) for i in xrange(50)])
+        self.assertEqual(urls(requests), ['/%d' % i for i in xrange(50)])
+
+    def test_compress(self):
+        path = self.write(compress=True)
+        self.assertTrue(path.endswith('.gz'))
+        self.assertEqual(os.listdir(self.dir), ['capture.log.gz'])
+        capture = CaptureFile(path)
+        records = capture._records_path
+        self.assertTrue(os.path.exists(records))
+        self.assertChunks(list(capture.iter_chunks()), self.chunks)
+        capture.close()
+        self.assertFalse(os.path.exists(records))
+
+    def test_split(self):
+        with CaptureFile(self.write()) as capture:
+            ranges = capture.split(4)
+            self.assertEqual(len(ranges), 4)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], capture.size)
+            chunks = []
+            for start, end in ranges:
+                self.assertEqual(capture.find_record(start), start)
+                chunks.extend(capture.iter_chunks(start, end))
+
+            # flags of file descriptors opened before a part are unknown
+            self.assertEqual([(c.tag.name, c.data) for c in chunks],
+                             [(c.tag.name, c.data) for c in self.chunks])
+            self.assertEqual(capture.find_record(capture.size + 4),
+                             capture.size)
+
+    def test_process(self):
+        with CaptureFile(self.write()) as capture:
+            result = capture.process(urls, operator.add, processes=2,
+                                     parts=4)
+
+        self.assertEqual(result, ['/%d' % i for i in xrange(50)])
+
+    def test_empty(self):
+        path = os.path.join(self.dir, 'empty.log')
+        open(path, 'wb').close()
+        with CaptureFile(path) as capture:
+            self.assertEqual(list(capture.iter_chunks()), [])
+            self.assertEqual(capture.split(4), [])
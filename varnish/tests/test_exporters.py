@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import calendar
+import socket
+import threading
+import unittest
+from ..exporters import _Exporter, StatsdExporter, GraphiteExporter
+from ..stats import VarnishStatsDelta
+from . import Point, reading, schema
+
+
+class ExporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = schema(Point('cache_hit', 'a'),
+                             Point('n_object', 'i'),
+                             Point('vcls', 'i', 'VBE', 'b1(127.0.0.1,,80)'),
+                             Point('c_req', 'a', 'SMA', 's0'))
+        self.first = reading(self.schema, (100, 3, 1, 10), 0)
+        self.second = reading(self.schema, (130, 5, 1, 10), 10)
+
+
+class StatsdExporterTest(ExporterTestCase):
+
+    def setUp(self):
+        super(StatsdExporterTest, self).setUp()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(0.5)
+        self.exporter = StatsdExporter('127.0.0.1',
+                                       self.server.getsockname()[1])
+
+    def tearDown(self):
+        self.exporter.close()
+        self.server.close()
+
+    def receive(self):
+        datagrams = []
+        try:
+            while True:
+                datagrams.append(self.server.recv(65536))
+
+        except socket.timeout:
+            return datagrams
+
+    def lines(self):
+        return [l for d in self.receive() for l in d.split('\n')]
+
+    def test_readings(self):
+        self.exporter.export(self.first)
+        # no previous reading: only gauges
+        self.assertEqual(self.lines(), ['varnish.n_object:3|g',
+                                        'varnish.VBE.b1_127_0_0_1__80_.vcls'
+                                        ':1|g'])
+        self.exporter.export(self.second)
+        # unchanged counters are not sent
+        self.assertEqual(self.lines(), ['varnish.cache_hit:30|c',
+                                        'varnish.n_object:5|g',
+                                        'varnish.VBE.b1_127_0_0_1__80_.vcls'
+                                        ':1|g'])
+
+    def test_counter_reset(self):
+        self.exporter.export(self.second)
+        self.exporter.export(self.first)
+        self.assertIn('varnish.cache_hit:100|c', self.lines())
+
+    def test_delta_reset(self):
+        restarted = reading(self.schema, (5, 1, 1, 2), 20)
+        self.exporter.export(restarted.delta(self.second))
+        # reset counters are incremented by their new value
+        self.assertEqual(self.lines(), ['varnish.cache_hit:5|c',
+                                        'varnish.n_object:1|g',
+                                        'varnish.VBE.b1_127_0_0_1__80_.vcls'
+                                        ':1|g',
+                                        'varnish.SMA.s0.c_req:2|c'])
+        delta = VarnishStatsDelta(self.schema, [-125, -4, 0, 3], 10)
+        self.exporter.export(delta)
+        self.assertEqual(self.lines(), ['varnish.SMA.s0.c_req:3|c'])
+
+    def test_delta(self):
+        self.exporter.export(self.second.delta(self.first))
+        # gauges are sent with their absolute value, not as deltas
+        self.assertEqual(self.lines(), ['varnish.cache_hit:30|c',
+                                        'varnish.n_object:5|g',
+                                        'varnish.VBE.b1_127_0_0_1__80_.vcls'
+                                        ':1|g'])
+
+    def test_delta_without_reading(self):
+        delta = VarnishStatsDelta(self.schema, [30, 2, 0, 0], 10)
+        self.exporter.export(delta)
+        self.assertEqual(self.lines(), ['varnish.cache_hit:30|c'])
+
+    def test_mtu(self):
+        points = [Point('c%d' % i, 'i') for i in xrange(300)]
+        exporter = StatsdExporter('127.0.0.1', self.server.getsockname()[1],
+                                  prefix='p', mtu=512)
+        try:
+            exporter.export(reading(schema(*points), range(300)))
+
+        finally:
+            exporter.close()
+
+        datagrams = self.receive()
+        self.assertEqual(len(datagrams), exporter.datagrams)
+        self.assertTrue(len(datagrams) > 1)
+        self.assertTrue(all(len(d) <= 512 for d in datagrams))
+        lines = [l for d in datagrams for l in d.split('\n')]
+        self.assertEqual(lines, ['p.c%d:%d|g' % (i, i) for i in xrange(300)])
+        self.assertEqual(exporter.exported, 300)
+
+
+class GraphiteExporterTest(ExporterTestCase):
+
+    def setUp(self):
+        super(GraphiteExporterTest, self).setUp()
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.server.settimeout(5)
+        self.exporter = GraphiteExporter('127.0.0.1',
+                                         self.server.getsockname()[1],
+                                         buffer_size=64)
+        self.data = []
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.start()
+
+    def accept(self):
+        connection, _ = self.server.accept()
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+
+            self.data.append(data)
+
+        connection.close()
+
+    def lines(self):
+        self.exporter.close()
+        self.thread.join()
+        self.server.close()
+        return ''.join(self.data).splitlines()
+
+    def timestamp(self, reading):
+        return calendar.timegm(reading.timestamp.utctimetuple())
+
+    def test_reading(self):
+        self.exporter.export(self.second)
+        ts = self.timestamp(self.second)
+        self.assertEqual(self.lines(),
+                         ['varnish.cache_hit 130 %d' % ts,
+                          'varnish.n_object 5 %d' % ts,
+                          'varnish.VBE.b1_127_0_0_1__80_.vcls 1 %d' % ts,
+                          'varnish.SMA.s0.c_req 10 %d' % ts])
+        self.assertEqual(self.exporter.exported, 4)
+
+    def test_delta(self):
+        self.exporter.export(self.second.delta(self.first))
+        ts = self.timestamp(self.second)
+        # counters as deltas, gauges with their absolute value
+        self.assertEqual(self.lines(),
+                         ['varnish.cache_hit 30 %d' % ts,
+                          'varnish.n_object 5 %d' % ts,
+                          'varnish.VBE.b1_127_0_0_1__80_.vcls 1 %d' % ts,
+                          'varnish.SMA.s0.c_req 0 %d' % ts])
+
+    def test_delta_reset(self):
+        restarted = reading(self.schema, (5, 1, 1, 2), 20)
+        self.exporter.export(restarted.delta(self.second))
+        ts = self.timestamp(restarted)
+        # reset counters are sent with their new value
+        self.assertEqual(self.lines(),
+                         ['varnish.cache_hit 5 %d' % ts,
+                          'varnish.n_object 1 %d' % ts,
+                          'varnish.VBE.b1_127_0_0_1__80_.vcls 1 %d' % ts,
+                          'varnish.SMA.s0.c_req 2 %d' % ts])
+
+    def test_delta_reset_without_reading(self):
+        self.exporter.export(VarnishStatsDelta(self.schema,
+                                               [-125, -4, 0, 3], 10))
+        self.assertEqual([l.split()[:2] for l in self.lines()],
+                         [['varnish.SMA.s0.c_req', '3']])
+
+    def test_reconnect(self):
+        self.exporter.export(self.first)
+        self.exporter._disconnect()
+        self.thread.join()
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.start()
+        self.exporter.export(self.second)
+        lines = self.lines()
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(lines[4].split()[:2], ['varnish.cache_hit', '130'])
+
+
+class ExporterTest(unittest.TestCase):
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, _Exporter, 'varnish')
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import unittest
+from ..history import StatsHistory
+from . import Point, reading, schema
+
+
+class StatsHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = schema(Point('cache_hit', 'a'), Point('n_object', 'i'))
+        # 10 hits per second, gauge cycling through 0-6
+        self.history = StatsHistory(size=100, rollups=((60, 10), (300, 5)))
+        for s in xrange(1000):
+            self.history.add(reading(self.schema, (s * 10, s % 7), s))
+
+    def test_rate_from_readings(self):
+        self.assertEqual(self.history.rate('cache_hit', 30), 10.0)
+
+    def test_rate_from_finest_covering_rollup(self):
+        # 600s is covered by 10 slots of 60s, 1200s by 5 slots of 300s
+        self.assertAlmostEqual(self.history.rate('cache_hit', 600), 10.0)
+        self.assertAlmostEqual(self.history.rate('cache_hit', 1200), 10.0)
+
+    def test_rate_not_covered(self):
+        self.assertIsNone(self.history.rate('cache_hit', 12 * 3600))
+
+    def test_rate_gauge(self):
+        self.assertRaises(ValueError, self.history.rate, 'n_object', 30)
+
+    def test_rate_not_enough_history(self):
+        history = StatsHistory(size=10, rollups=())
+        history.add(reading(self.schema, (0, 0), 0))
+        self.assertIsNone(history.rate('cache_hit', 1))
+
+    def test_no_counters(self):
+        # i.e. readings of a VarnishStats.filter() matching nothing
+        history = StatsHistory(size=10, rollups=((60, 10),))
+        empty = schema()
+        for s in xrange(120):
+            history.add(reading(empty, (), s))
+
+        self.assertEqual(history.names, ())
+
+    def test_rollup(self):
+        samples = self.history.rollup('n_object', 60)
+        self.assertTrue(0 < len(samples) <= 10)
+        for end, min_, max_, avg in samples:
+            self.assertEqual((min_, max_), (0, 6))
+            self.assertTrue(0 <= avg <= 6)
+
+        ends = [s[0] for s in samples]
+        self.assertEqual(ends, sorted(ends))
+        for end, min_, max_, avg in self.history.rollup('cache_hit', 300):
+            self.assertEqual((min_, max_), (10, 10))
+
+        self.assertRaises(KeyError, self.history.rollup, 'cache_hit', 30)
+
+    def test_samples(self):
+        samples = self.history.samples('cache_hit', 3)
+        self.assertEqual([v for t, v in samples], [9960, 9970, 9980, 9990])
+        self.assertEqual(len(self.history.samples('cache_hit')), 100)
+
+    def test_new_counters_clear(self):
+        other = schema(Point('cache_miss', 'a'))
+        self.history.add(reading(other, (1, ), 1000))
+        self.assertEqual(len(self.history), 1)
+        self.assertRaises(KeyError, self.history.rate, 'cache_hit', 1)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import unittest
+from datetime import datetime
+from .. import vsl
+from ..logs import (BackendRequestLog, ClientRequestLog, CorrelationTable,
+                    RequestLogAssembler, request_dispatcher)
+from . import chunk
+
+_STARTED = 1349792323.25
+_COMPLETED = 1349792323.5
+
+
+def client_request(fd, xid, url, calls=('recv', 'lookup', 'hit', 'deliver'),
+                   backend_fd=None):
+    """ Return the chunks of a client request going through the vcl_*
+        `calls`, each followed by the next as return value """
+    client = vsl.VSL_S_CLIENT
+    chunks = [chunk('reqstart', fd, '127.0.0.1 5000 %d' % xid, client),
+              chunk('rxrequest', fd, 'GET', client),
+              chunk('rxurl', fd, url, client)]
+    for call, ret in zip(calls[::2], calls[1::2]):
+        chunks.append(chunk('vcl_call', fd, call, client))
+        chunks.append(chunk('vcl_return', fd, ret, client))
+        if call in ('miss', 'pass') and backend_fd is not None:
+            chunks.append(chunk('backend', fd,
+                                '%d default default' % backend_fd, client))
+
+    chunks.extend([chunk('txstatus', fd, '200', client),
+                   chunk('reqend', fd, '%d %.3f %.3f 0.0 0.0 0.0' %
+                         (xid, _STARTED, _COMPLETED), client)])
+    return chunks
+
+
+def backend_request(fd, xid, url):
+    """ Return the chunks of the backend request of client request `xid`
+    """
+    backend = vsl.VSL_S_BACKEND
+    return [chunk('backendopen', fd, 'default 127.0.0.1 6000 127.0.0.1 80',
+                  backend),
+            chunk('txrequest', fd, 'GET', backend),
+            chunk('txurl', fd, url, backend),
+            chunk('txheader', fd, 'X-Varnish: %d' % xid, backend),
+            chunk('rxstatus', fd, '200', backend),
+            chunk('backendclose', fd, 'default', backend)]
+
+
+def miss(xid, url, fd=12, backend_fd=14):
+    """ Return the chunks of a miss: the backend request is read first """
+    return backend_request(backend_fd, xid, url) + \
+        client_request(fd, xid, url, ('recv', 'lookup', 'miss', 'fetch',
+                                      'deliver', 'deliver'), backend_fd)
+
+
+class RequestLogAssemblerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.evicted = []
+        self.assembler = RequestLogAssembler(
+                            max_pending=2, evict_callback=self.evicted.append)
+
+    def add(self, chunks):
+        return [self.assembler.add(c) for c in chunks]
+
+    def test_assemble(self):
+        chunks = client_request(12, 1001, '/a')
+        requests = self.add(chunks)
+        request = requests[-1]
+        self.assertTrue(all(r is request for r in requests))
+        self.assertIsInstance(request, ClientRequestLog)
+        self.assertTrue(request.complete)
+        self.assertEqual(request.url, '/a')
+        self.assertEqual(request.chunks, chunks)
+        self.assertEqual(len(self.assembler), 0)
+
+    def test_nonrequest(self):
+        self.assertIsNone(self.assembler.add(chunk('cli', 0, 'Rd ping')))
+        # records of a request whose start was not read
+        self.assertIsNone(self.assembler.add(
+                                client_request(12, 1001, '/a')[-1]))
+
+    def test_max_pending(self):
+        for fd in (12, 13, 14):
+            self.add(client_request(fd, 1000 + fd, '/%d' % fd)[:2])
+
+        self.assertEqual(len(self.assembler), 2)
+        self.assertEqual(self.assembler.evicted, 1)
+        self.assertEqual([r.fd for r in self.evicted], [12])
+        # the evicted request is not completed by its later records
+        self.assertIsNone(self.assembler.add(
+                                client_request(12, 1012, '/12')[-1]))
+        request = self.assembler.add(client_request(13, 1013, '/13')[-1])
+        self.assertTrue(request.complete)
+
+    def test_unlimited(self):
+        assembler = RequestLogAssembler(max_pending=None)
+        for fd in xrange(1, 1001):
+            assembler.add(client_request(fd, fd, '/')[0])
+
+        self.assertEqual(len(assembler), 1000)
+        self.assertEqual(assembler.evicted, 0)
+
+    def test_max_age(self):
+        assembler = RequestLogAssembler(max_age=10,
+                                        evict_callback=self.evicted.append)
+        assembler.add(client_request(12, 1001, '/a')[0])
+        assembler.add(client_request(13, 1002, '/b')[0])
+        assembler._lines[12].started -= 20
+        assembler.add(client_request(14, 1003, '/c')[0])
+        self.assertEqual(assembler.evicted, 1)
+        self.assertEqual([r.fd for r in self.evicted], [12])
+        self.assertEqual(len(assembler), 2)
+
+    def test_lost_end(self):
+        self.add(client_request(12, 1001, '/a')[:-1])
+        request = self.add(client_request(12, 1002, '/b'))[-1]
+        self.assertEqual(self.assembler.evicted, 1)
+        self.assertEqual(self.evicted[0].url, '/a')
+        self.assertEqual(request.url, '/b')
+        self.assertEqual(request.id, '1002')
+
+    def test_clear(self):
+        self.add(client_request(12, 1001, '/a')[:2])
+        self.assembler.clear()
+        self.assertEqual(len(self.assembler), 0)
+        self.assertEqual(self.assembler.evicted, 0)
+
+    def test_independent(self):
+        # two readers in the same process do not share their state
+        other = RequestLogAssembler()
+        first = client_request(12, 1001, '/a')
+        second = client_request(12, 2001, '/b')
+        for a, b in zip(first, second):
+            ours = self.assembler.add(a)
+            theirs = other.add(b)
+
+        self.assertEqual((ours.url, ours.id), ('/a', '1001'))
+        self.assertEqual((theirs.url, theirs.id), ('/b', '2001'))
+        self.assertTrue(ours.complete and theirs.complete)
+
+    def test_backend(self):
+        requests = self.add(backend_request(14, 1001, '/a'))
+        request = requests[-1]
+        self.assertIsInstance(request, BackendRequestLog)
+        self.assertTrue(request.complete)
+        self.assertEqual(request.backend_name, 'default')
+        self.assertEqual(request.txheaders.getone('x-varnish'), '1001')
+
+
+class CorrelationTableTest(unittest.TestCase):
+
+    def test_max_size(self):
+        table = CorrelationTable(max_size=2)
+        for key in 'abc':
+            table.add(key, key.upper())
+
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.evicted, 1)
+        self.assertNotIn('a', table)
+        self.assertEqual(table.pop('c'), 'C')
+
+    def test_unlimited(self):
+        table = CorrelationTable(max_size=None)
+        for i in xrange(5000):
+            table.add(i, i)
+
+        self.assertEqual(len(table), 5000)
+        self.assertEqual(table.evicted, 0)
+        self.assertEqual(table.pop(0), 0)
+
+    def test_replace(self):
+        table = CorrelationTable()
+        table.add('a', 1)
+        table.add('a', 2)
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.evicted, 1)
+        self.assertEqual(table.pop('a'), 2)
+
+    def test_max_age(self):
+        table = CorrelationTable(max_age=10)
+        table.add('a', 1)
+        now, value = table._entries['a']
+        table._entries['a'] = (now - 20, value)
+        table.add('b', 2)
+        self.assertEqual(table.evicted, 1)
+        self.assertNotIn('a', table)
+
+    def test_counters(self):
+        table = CorrelationTable(max_size=None)
+        table.add('a', 1)
+        self.assertEqual(table.pop('a'), 1)
+        self.assertIsNone(table.pop('a'))
+        self.assertEqual((table.hits, table.misses), (1, 1))
+
+    def test_dispatcher(self):
+        # an empty, unlimited table is false but still used
+        table = CorrelationTable(max_size=None)
+        requests = []
+        cb = request_dispatcher(requests.append, aggregate=table)
+        chunks = miss(1001, '/miss') + \
+            client_request(12, 1002, '/hit') + \
+            client_request(12, 1003, '/pass', ('recv', 'pass', 'pass',
+                                               'pass', 'deliver', 'deliver'))
+        for c in chunks:
+            cb(c)
+
+        self.assertEqual([r.url for r in requests],
+                         ['/miss', '/hit', '/pass'])
+        backend = requests[0].backend_request
+        self.assertIsInstance(backend, BackendRequestLog)
+        self.assertEqual(backend.url, '/miss')
+        self.assertIsNone(requests[1].backend_request)
+        self.assertIsNone(requests[2].backend_request)
+        # hits are not looked up, the pass had no backend request read
+        self.assertEqual((table.hits, table.misses, table.evicted),
+                         (1, 1, 0))
+        self.assertEqual(len(table), 0)
+
+
+class FieldsTest(unittest.TestCase):
+
+    def test_projection(self):
+        settings = ClientRequestLog.projection(['id', 'client_ip',
+                                                'client_port'])
+        code = vsl.LogChunk.tags['reqstart'].code
+        self.assertIn(code, settings['_handlers'])
+        self.assertRaises(ValueError, ClientRequestLog.projection,
+                          ['unknown'])
+
+    def test_aggregate(self):
+        # an empty CorrelationTable is false, but aggregates too
+        for aggregate in (10, CorrelationTable()):
+            requests = []
+            cb = request_dispatcher(requests.append, aggregate=aggregate,
+                                    fields=['id', 'client_ip', 'url'])
+            for c in miss(1001, '/a'):
+                cb(c)
+
+            request, = requests
+            self.assertEqual(request.id, '1001')
+            self.assertEqual(request.client_ip, '127.0.0.1')
+            self.assertEqual(request.url, '/a')
+            self.assertIsNone(request.status)
+            self.assertEqual(request.backend_request.url, '/a')
+
+
+class TimestampsTest(unittest.TestCase):
+
+    def test_repr_before_reqend(self):
+        assembler = RequestLogAssembler()
+        chunks = client_request(12, 1001, '/a')
+        for c in chunks[:-1]:
+            request = assembler.add(c)
+
+        self.assertIn('started   : None', repr(request))
+        self.assertIsNone(request.started_at)
+        assembler.add(chunks[-1])
+        self.assertEqual(request.started_at,
+                         datetime.fromtimestamp(_STARTED))
+        self.assertEqual(request.completed_at,
+                         datetime.fromtimestamp(_COMPLETED))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import unittest
+from ..utils import MultiDict
+
+
+class MultiDictTrimTest(unittest.TestCase):
+
+    def test_keeps_newest(self):
+        d = MultiDict()
+        for i in xrange(100):
+            d['k%d' % (i % 3)] = i
+
+        d.trim(10)
+        self.assertEqual(len(d), 10)
+        self.assertEqual(d.values(), range(90, 100))
+        self.assertEqual(d['k0'], [90, 93, 96, 99])
+
+    def test_repeated_trims(self):
+        d = MultiDict()
+        for i in xrange(5000):
+            d['k%d' % (i % 7)] = i
+            d.trim(50)
+
+        self.assertEqual(len(d), 50)
+        self.assertEqual(d.values(), range(4950, 5000))
+        self.assertEqual(d.keys()[0], 'k%d' % (4950 % 7))
+
+    def test_trim_after_deletes(self):
+        d = MultiDict([('a', 1), ('b', 2), ('a', 3), ('c', 4), ('d', 5)])
+        d.trim(4)
+        del d['c']
+        d.pop('b')
+        d['e'] = 6
+        d.trim(2)
+        self.assertEqual(d.items(), [('d', 5), ('e', 6)])
+        d.trim(0)
+        self.assertEqual(len(d), 0)
+        d['f'] = 7
+        self.assertEqual(d.items(), [('f', 7)])
+
+    def test_trim_larger(self):
+        d = MultiDict([('a', 1), ('b', 2)])
+        d.trim(5)
+        self.assertEqual(d.items(), [('a', 1), ('b', 2)])
+
+    def test_clear(self):
+        d = MultiDict([('a', 1), ('b', 2), ('c', 3)])
+        d.trim(1)
+        d.clear()
+        d['x'] = 1
+        d['y'] = 2
+        d.trim(1)
+        self.assertEqual(d.items(), [('y', 2)])
+
+    def test_trim_after_popitem(self):
+        d = MultiDict([(i, i) for i in xrange(4)])
+        d.trim(1)
+        d.popitem()
+        self.assertRaises(KeyError, d.popitem)
+        d['a'] = 1
+        d['b'] = 2
+        d.trim(1)
+        self.assertEqual(d.items(), [('b', 2)])
+
+    def test_trim_after_popitem_empties(self):
+        d = MultiDict([(i, i) for i in xrange(4)])
+        d.trim(1)
+        d.popitem()
+        self.assertRaises(KeyError, d.popitem)
+        for k in 'abcdef':
+            d[k] = k
+
+        # the oldest items are discarded, not those after the old head
+        d.trim(2)
+        self.assertEqual(d.items(), [('e', 'e'), ('f', 'f')])
@@ -24,7 +24,7 @@ WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 import collections
 import logging
-__all__ = ['setup_logging', 'MultiDict']
+__all__ = ['setup_logging', 'MultiDict', 'cached_property']
 
 
 class _NullHandler(logging.Handler):
@@ -51,6 +51,26 @@ def setup_logging():
     logger.addHandler(_NullHandler)
 
 
+class cached_property(object):
+    """ Decorator for properties computed on first access only: the result
+        is stored in the instance __dict__, which takes precedence over the
+        property on next accesses.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.__name__ = function.__name__
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = self.function(instance)
+        instance.__dict__[self.__name__] = value
+        return value
+
+
 class MultiDict(collections.MutableMapping):
     """
         This is a modified version of MultiDict shamelessly stolen from WebOb
@@ -68,60 +88,85 @@ class MultiDict(collections.MutableMapping):
         if len(args) > 1:
             raise TypeError("MultiDict can only be called with one positional "
                             "argument")
+        self._items = []
+        self._index = {}
+        self._deleted = 0
+        self._head = 0
         if args:
             if hasattr(args[0], 'iteritems'):
-                items = list(args[0].iteritems())
+                items = args[0].iteritems()
             elif hasattr(args[0], 'items'):
                 items = args[0].items()
             else:
-                items = list(args[0])
-            self._items = items
-        else:
-            self._items = []
+                items = args[0]
+            for key, value in items:
+                self[key] = value
         if kw:
-            self._items.extend(kw.items())
+            for key, value in kw.items():
+                self[key] = value
+
+    # Items are kept in insertion order in self._items, while self._index
+    # maps every key to the (ascending) positions of its items.
+    # Deleted items are replaced by None and the list is compacted when
+    # they are more than the live ones. Items before self._head are all
+    # deleted, so trim() does not scan them again.
+
+    def _remove(self, pos):
+        key = self._items[pos][0]
+        self._items[pos] = None
+        self._deleted += 1
+        positions = self._index[key]
+        positions.remove(pos)
+        if not positions:
+            del self._index[key]
+
+    def _compact(self):
+        if self._deleted < 16 or self._deleted * 2 < len(self._items):
+            return
+
+        items = [item for item in self._items if item is not None]
+        self._items = []
+        self._index = {}
+        self._deleted = 0
+        self._head = 0
+        for key, value in items:
+            self[key] = value
 
     def __getitem__(self, key):
         """
         Return a list of all values matching the key (may be an empty list)
         """
-        result = []
-        for k, v in self._items:
-            if key == k:
-                result.append(v)
-
-        if not result:
-            raise KeyError(key)
-
-        return result
+        items = self._items
+        return [items[i][1] for i in self._index[key]]
 
     def __setitem__(self, key, value):
         """
         Add the key and value, not overwriting any previous value.
         """
+        positions = self._index.get(key)
+        if positions is None:
+            self._index[key] = [len(self._items)]
+
+        else:
+            positions.append(len(self._items))
+
         self._items.append((key, value))
 
     def __delitem__(self, key):
+        positions = self._index.pop(key)
         items = self._items
-        found = False
-        for i in range(len(items) - 1, -1, -1):
-            if items[i][0] == key:
-                del items[i]
-                found = True
-
-        if not found:
-            raise KeyError(key)
+        for i in positions:
+            items[i] = None
+        self._deleted += len(positions)
+        self._compact()
 
     def overwrite(self, key, value):
         """
         Set the value at key, discarding previous values set if any
         """
-        try:
+        if key in self._index:
             del self[key]
 
-        except:
-            pass
-
         self[key] = value
 
     def getone(self, key):
@@ -129,73 +174,89 @@ class MultiDict(collections.MutableMapping):
         Get one value matching the key, raising a KeyError if multiple
         values were found.
         """
-        v = self[key]
-        if len(v) > 1:
-            raise KeyError('Multiple values match %r: %r' % (key, v))
+        positions = self._index[key]
+        if len(positions) > 1:
+            raise KeyError('Multiple values match %r: %r' % (key, self[key]))
 
-        return v[0]
+        return self._items[positions[0]][1]
 
     def dict_of_lists(self):
         """
         Returns a dictionary where each key is associated with a list of values
         """
         r = {}
-        for key, val in self.items():
+        for key, val in self.iteritems():
             r.setdefault(key, []).append(val)
         return r
 
     def __contains__(self, key):
-        for k, v in self._items:
-            if k == key:
-                return True
-        return False
+        return key in self._index
 
     has_key = __contains__
 
     def clear(self):
-        del self._items[:]
+        self._items = []
+        self._index = {}
+        self._deleted = 0
+        self._head = 0
 
     def copy(self):
         return self.__class__(self)
 
     def setdefault(self, key, default=None):
-        for k, v in self._items:
-            if key == k:
-                return v
-        self._items.append((key, default))
+        positions = self._index.get(key)
+        if positions:
+            return self._items[positions[0]][1]
+        self[key] = default
         return default
 
     def pop(self, key, *args):
         if len(args) > 1:
             raise TypeError("pop expected at most 2 arguments, got %s"
                              % repr(1 + len(args)))
-        for i in range(len(self._items)):
-            if self._items[i][0] == key:
-                v = self._items[i][1]
-                del self._items[i]
-                return v
+        positions = self._index.get(key)
+        if positions:
+            pos = positions[0]
+            v = self._items[pos][1]
+            self._remove(pos)
+            self._compact()
+            return v
         if args:
             return args[0]
         else:
             raise KeyError(key)
 
     def popitem(self):
-        return self._items.pop()
+        items = self._items
+        while items and items[-1] is None:
+            items.pop()
+            self._deleted -= 1
+        # trim() starts from _head, which must stay within the list
+        self._head = min(self._head, len(items))
+        if not items:
+            raise KeyError('popitem(): dictionary is empty')
+        item = items[-1]
+        self._remove(len(items) - 1)
+        items.pop()
+        self._deleted -= 1
+        self._head = min(self._head, len(items))
+        return item
 
     def extend(self, other=None, **kwargs):
         if other is None:
             pass
 
         elif hasattr(other, 'items'):
-            self._items.extend(other.items())
+            for k, v in other.items():
+                self[k] = v
 
         elif hasattr(other, 'keys'):
             for k in other.keys():
-                self._items.append((k, other[k]))
+                self[k] = other[k]
 
         else:
             for k, v in other:
-                self._items.append((k, v))
+                self[k] = v
 
         if kwargs:
             self.update(kwargs)
@@ -205,35 +266,53 @@ class MultiDict(collections.MutableMapping):
         return '%s([%s])' % (self.__class__.__name__, ', '.join(items))
 
     def __len__(self):
-        return len(self._items)
+        return len(self._items) - self._deleted
 
     def iterkeys(self):
-        for k, v in self._items:
-            yield k
+        for item in self._items:
+            if item is not None:
+                yield item[0]
 
     def keys(self):
-        return [k for k, v in self._items]
+        return list(self.iterkeys())
 
     __iter__ = iterkeys
 
     def iteritems(self):
-        return iter(self._items)
+        for item in self._items:
+            if item is not None:
+                yield item
 
     def items(self):
-        return self._items[:]
+        if not self._deleted:
+            return self._items[:]
+        return list(self.iteritems())
 
     def itervalues(self):
-        for k, v in self._items:
-            yield v
+        for item in self._items:
+            if item is not None:
+                yield item[1]
 
     def values(self):
-        return [v for k, v in self._items]
+        return list(self.itervalues())
 
     def trim(self, size):
-        if len(self) <= size:
+        """
+        Discard the oldest items, keeping at most `size` of them
+        """
+        exceeding = len(self) - size
+        if exceeding <= 0:
             return
 
-        self._items = self._items[-size:]
+        items = self._items
+        i = self._head
+        while exceeding:
+            if items[i] is not None:
+                self._remove(i)
+                exceeding -= 1
+            i += 1
+        self._head = i
+        self._compact()
 
 
 def _hide_passwd(items):
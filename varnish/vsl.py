@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2012 Giacomo Bagnoli <g.bagnoli@asidev.com>
+
+Permission is hereby granted, free of charge, to any person obtaining
+a copy of this software and associated documentation files (the
+"Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish,
+distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be
+included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import ctypes
+
+__all__ = ['LogTag', 'LogChunk', 'TAGS', 'TAGS_BY_CODE', 'VSL_S_CLIENT',
+           'VSL_S_BACKEND']
+
+LogTag = collections.namedtuple('LogTag', ['code', 'name'])
+
+# Varnish 3.0 log tags (include/vsl_tags.h) in code order, starting from 1
+# (0 is SLT_Bogus). Used where libvarnishapi, and its VSL_tags table, is not
+# available, i.e. to read capture files.
+_NAMES = ('Debug', 'Error', 'CLI', 'StatSess', 'ReqEnd', 'SessionOpen',
+          'SessionClose', 'BackendOpen', 'BackendXID', 'BackendReuse',
+          'BackendClose', 'HttpGarbage', 'Backend', 'Length', 'FetchError',
+          'RxRequest', 'RxResponse', 'RxStatus', 'RxURL', 'RxProtocol',
+          'RxHeader', 'TxRequest', 'TxResponse', 'TxStatus', 'TxURL',
+          'TxProtocol', 'TxHeader', 'ObjRequest', 'ObjResponse', 'ObjStatus',
+          'ObjURL', 'ObjProtocol', 'ObjHeader', 'LostHeader', 'TTL',
+          'Fetch_Body', 'VCL_acl', 'VCL_call', 'VCL_trace', 'VCL_return',
+          'VCL_error', 'ReqStart', 'Hit', 'HitPass', 'ExpBan', 'ExpKill',
+          'WorkThread', 'ESI_xmlerror', 'Hash', 'Backend_health', 'VCL_Log',
+          'Gzip')
+
+# LogTag objects keyed on (lowercase) name, and indexed by code
+TAGS = dict((name.lower(), LogTag(code=code, name=name.lower()))
+            for code, name in enumerate(_NAMES, 1))
+TAGS_BY_CODE = tuple(dict((t.code, t) for t in TAGS.itervalues()).get(code)
+                     for code in xrange(256))
+
+VSL_S_CLIENT = (1 << 0)
+VSL_S_BACKEND = (1 << 1)
+
+
+class LogChunk(object):
+    """ Python object that represent a log entry.
+        `ptr` is either the address of the record data, which is copied
+        exactly `len_` bytes long, or a string already holding it.
+        Tags are resolved with the static Varnish 3.0 table, replaced by the
+        one exported by libvarnishapi when varnish.api.logs is imported.
+    """
+    __slots__ = ['tag', 'fd', 'spec', 'bitmap', '_data']
+    tags = TAGS
+    tags_by_code = TAGS_BY_CODE
+
+    def __init__(self, tag, fd, len_, spec, ptr, bitmap):
+        self.tag = self.tags_by_code[tag]
+        if self.tag is None:
+            raise KeyError(tag)
+
+        self.fd = fd  # file descriptor associated with this record
+        self.spec = spec
+        self.bitmap = bitmap
+        if not len_ or not ptr:
+            self._data = ""
+
+        elif isinstance(ptr, basestring):
+            self._data = ptr if len(ptr) == len_ else ptr[0:len_]
+
+        else:
+            self._data = ctypes.string_at(ptr, len_)
+
+    @property
+    def client(self):
+        return self.spec == VSL_S_CLIENT
+
+    @property
+    def backend(self):
+        return self.spec == VSL_S_BACKEND
+
+    @property
+    def data(self):
+        return self._data
+
+    def __str__(self):
+        type_ = "client" if self.client else "backend"
+        return "<LogChunk [%s] [%s] [%s]: %s>" % (self.fd, type_,
+                                                  self.tag.name,
+                                                  self.data.strip())
+
+    def __repr__(self):
+        return str(self)